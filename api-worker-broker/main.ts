@@ -160,8 +160,13 @@ http
     } catch (err) {
       return res.writeHead(500).end(err.message);
     }
+    let status = 200;
+    if (resBody.error) {
+      // The node raises InvalidInputError for requests that aren't valid queries.
+      status = resBody.error.type === "InvalidInputError" ? 400 : 502;
+    }
     res
-      .writeHead(resBody.error ? 502 : 200, {
+      .writeHead(status, {
         "content-type": "application/msgpack",
       })
       .end(encode(resBody.error ?? resBody.output));
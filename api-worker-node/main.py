@@ -1,9 +1,10 @@
-from common.data import load_ann
+from common.emb_data import load_ann
 from common.heatmap import render_heatmap
 from common.util import env
 from dataclasses import dataclass
 from dataclasses import field
 from dataclasses_json import dataclass_json
+from typing import Callable
 from typing import Dict
 from typing import Iterable
 from typing import List
@@ -11,6 +12,7 @@ from typing import Optional
 from typing import Tuple
 from typing import Union
 import base64
+import json
 import msgpack
 import os
 import requests
@@ -30,6 +32,7 @@ if USE_GPU:
     from cudf import DataFrame
     from cudf import Series
     import cupy as xp
+    import cupyx
 else:
     from common.data import ApiDataset
     from common.data import DatasetEmbModel
@@ -67,13 +70,80 @@ def assign_then_post_filter(
     return df
 
 
+def to_xp(s: Series):
+    if USE_GPU:
+        return s.to_cupy()
+    return s.to_numpy()
+
+
+def decode_dict_codes(d: ApiDataset, col: str, codes):
+    # Dictionaries are always on the host.
+    return d.dicts[col][xp.asnumpy(codes) if USE_GPU else codes]
+
+
+# Aggregations supported by agg_by_codes.
+FAST_GROUP_BY_AGGS = ("count", "max", "mean", "min", "sum")
+
+
+def agg_by_codes(codes, values, agg: str, n: int, counts):
+    """
+    Aggregates `values` into `n` groups, where `codes[i]` is the group of `values[i]`. `counts` must be `bincount(codes, minlength=n)`.
+    `values` must be a numeric or bool array. Results match a generic group by, including skipping NaN values; groups with no values have unspecified results.
+    """
+    if values.dtype.kind == "b":
+        # A generic group by sums and averages bools as integers, but keeps them as bools for min/max.
+        res = agg_by_codes(codes, values.astype(xp.int64), agg, n, counts)
+        return res.astype(xp.bool_) if agg in ("min", "max") else res
+    if values.dtype.kind == "f":
+        valid = ~xp.isnan(values)
+        if not valid.all():
+            codes = codes[valid]
+            values = values[valid]
+            counts = xp.bincount(codes, minlength=n)
+    if agg == "count":
+        return counts
+    if agg in ("sum", "mean"):
+        sums = xp.bincount(codes, weights=values, minlength=n)
+        if agg == "mean":
+            # Groups with only NaN values have a NaN mean.
+            res = xp.where(counts > 0, sums / xp.maximum(counts, 1), xp.nan)
+            return res.astype(values.dtype) if values.dtype.kind == "f" else res
+        if values.dtype.kind == "f":
+            return sums.astype(values.dtype)
+        # bincount always returns float64. A generic group by sums integers as 64-bit, then keeps the original dtype if every sum fits in it.
+        sums = sums.astype(xp.uint64 if values.dtype.kind == "u" else xp.int64)
+        info = xp.iinfo(values.dtype)
+        if info.min <= sums.min().item() and sums.max().item() <= info.max:
+            return sums.astype(values.dtype)
+        return sums
+    if agg in ("min", "max"):
+        if values.dtype.kind == "f":
+            init = xp.inf if agg == "min" else -xp.inf
+        else:
+            info = xp.iinfo(values.dtype)
+            init = info.max if agg == "min" else info.min
+        out = xp.full(n, init, dtype=values.dtype)
+        if USE_GPU:
+            (cupyx.scatter_min if agg == "min" else cupyx.scatter_max)(
+                out, codes, values
+            )
+        else:
+            (xp.minimum if agg == "min" else xp.maximum).at(out, codes, values)
+        if values.dtype.kind == "f":
+            # Groups with only NaN values have a NaN min/max.
+            out[counts == 0] = xp.nan
+        return out
+    raise ValueError(f"Unsupported aggregation: {agg}")
+
+
 def pack_rows(df: DataFrame, cols: Iterable[str]):
     final_count = len(df)
     out = struct.pack("<I", final_count)
     for col in cols:
         dt = df[col].dtype
         out += dt.kind.encode()
-        if dt == object:
+        # Check the kind instead of comparing to object, as newer pandas versions use a dedicated string dtype (which still has kind "O").
+        if dt.kind == "O":
             # Probably strings. Anyway, use msgpack for simplicity (instead of inventing our own mechanism).
             if USE_GPU:
                 # > TypeError: cuDF does not support conversion to host memory via the `tolist()` method. Consider using `.to_arrow().to_pylist()` to construct a Python list.
@@ -134,6 +204,14 @@ class ItemsOutput:
         df = df.sort_values(self.order_by, ascending=self.order_asc)
         if self.limit is not None:
             df = df[: self.limit]
+        # Dictionary-encoded columns are stored as integer codes, so resolve the returned rows' codes back to their values.
+        df = df.assign(
+            **{
+                c: Series(decode_dict_codes(d, c, to_xp(df[c])), index=df.index)
+                for c in self.cols
+                if c in d.dicts
+            }
+        )
         return pack_rows(df, self.cols)
 
 
@@ -152,17 +230,104 @@ class GroupByOutput:
     order_asc: bool = True
     limit: Optional[int] = None
 
-    def calculate(self, d: ApiDataset, df: DataFrame):
+    def calculate_by_codes(
+        self,
+        df: DataFrame,
+        codes,
+        n: int,
+        # Converts codes to the output group values.
+        to_groups: Callable,
+        # Whether the group values are in the same order as their codes.
+        groups_sorted: bool,
+    ):
+        # Aggregate into arrays indexed by code in a single pass, which is much faster than a generic group by.
+        counts = xp.bincount(codes, minlength=n)
+        # Only codes with at least one row are groups.
+        present = xp.flatnonzero(counts)
+        res = {
+            c: agg_by_codes(codes, to_xp(df[c]), agg, n, counts)[present]
+            for c, agg in self.cols
+        }
+        if self.order_by == "group" and groups_sorted:
+            # `present` is already in ascending order.
+            order = xp.arange(present.shape[0])
+        elif self.order_by == "group":
+            order = xp.argsort(to_groups(present), kind="stable")
+        else:
+            order = xp.argsort(res[self.order_by], kind="stable")
+        if not self.order_asc:
+            order = order[::-1]
+            if self.order_by != "group" and res[self.order_by].dtype.kind == "f":
+                # A generic sort puts NaN values last in both directions, but reversing the ascending order puts them first.
+                nan = xp.isnan(res[self.order_by][order])
+                order = xp.concatenate([order[~nan], order[nan]])
+        if self.limit is not None:
+            order = order[: self.limit]
+        out = DataFrame(
+            {
+                "group": to_groups(present[order]),
+                **{c: res[c][order] for c, _ in self.cols},
+            }
+        )
+        return pack_rows(out, ["group"] + [c for c, _ in self.cols])
+
+    def calculate_dict(self, d: ApiDataset, df: DataFrame):
+        # `self.by` is a dictionary-encoded column, so group by the integer codes instead of strings. Only resolve codes to strings for the final output groups.
+        return self.calculate_by_codes(
+            df,
+            to_xp(df[self.by]).astype(xp.int64),
+            d.dicts[self.by].shape[0],
+            lambda codes: decode_dict_codes(d, self.by, codes),
+            groups_sorted=False,
+        )
+
+    def calculate_bucketed(self, df: DataFrame):
+        assert self.bucket is not None
+        groups = (to_xp(df[self.by]) // self.bucket).astype(xp.int32)
+        g_min = groups.min().item()
+        # Bucket indices are contiguous integers, so they can be used directly as codes after offsetting by the minimum.
+        n = groups.max().item() - g_min + 1
+        if n > max(1_000_000, 10 * groups.shape[0]):
+            # The range is too sparse for arrays indexed by code to be efficient.
+            return None
+        return self.calculate_by_codes(
+            df,
+            (groups - g_min).astype(xp.int64),
+            n,
+            lambda codes: (codes + g_min).astype(xp.int32),
+            groups_sorted=True,
+        )
+
+    def calculate_generic(self, d: ApiDataset, df: DataFrame):
         if self.bucket is not None:
             df = df.assign(group=(df[self.by] // self.bucket).astype("int32"))
         else:
             df = df.assign(group=df[self.by])
         df = df.groupby("group", as_index=False).agg(dict(self.cols))
+        if self.bucket is None and self.by in d.dicts:
+            # We grouped by the integer codes, so resolve them to their values (before sorting, so groups are ordered by value).
+            df["group"] = Series(
+                decode_dict_codes(d, self.by, to_xp(df["group"])), index=df.index
+            )
         df = df.sort_values(self.order_by, ascending=self.order_asc)
         if self.limit is not None:
             df = df[: self.limit]
         return pack_rows(df, ["group"] + [c for c, _ in self.cols])
 
+    def calculate(self, d: ApiDataset, df: DataFrame):
+        # The single pass engine only supports some aggregations of numeric and bool columns.
+        fast = len(df) and all(
+            agg in FAST_GROUP_BY_AGGS and df[c].dtype.kind in "biuf"
+            for c, agg in self.cols
+        )
+        if fast and self.bucket is None and self.by in d.dicts:
+            return self.calculate_dict(d, df)
+        if fast and self.bucket is not None:
+            out = self.calculate_bucketed(df)
+            if out is not None:
+                return out
+        return self.calculate_generic(d, df)
+
 
 @dataclass_json
 @dataclass
@@ -182,6 +347,11 @@ class Output:
         assert False
 
 
+class InvalidInputError(ValueError):
+    # The broker responds with a 400 instead of a 502 for this error type.
+    pass
+
+
 # We don't support pre-filtering: it requires selecting arbitrary rows in the embedding matrix, which can literally be tens of gigabytes and is extremely slow. Most of the time, post filtering is better.
 @dataclass_json
 @dataclass
@@ -198,6 +368,12 @@ class QueryInput:
     # If provided, will first filter to this many ANN rows using the ANN index.
     pre_filter_ann: Optional[int] = None
 
+    # If provided, will only score rows in this many clusters with the closest centroids to each query. This requires the dataset to be built with clusters. Higher values have better recall but are slower.
+    pre_filter_clusters: Optional[int] = None
+
+    # If provided, will first score every row using the dataset's reduced embeddings, then only score this many of the top rows using the full embeddings. This requires the dataset to be built with reduced embeddings.
+    pre_filter_reduced: Optional[int] = None
+
     # Scale each column into a new column `{col}_scaled`.
     scales: Dict[str, Clip] = field(default_factory=dict)
 
@@ -212,6 +388,12 @@ class QueryInput:
     # Filter out rows where their column values are outside this range.
     post_filter_clip: Dict[str, Clip] = field(default_factory=dict)
 
+    def __post_init__(self):
+        if self.pre_filter_clusters is not None and self.pre_filter_clusters < 1:
+            raise InvalidInputError("pre_filter_clusters must be at least 1")
+        if self.pre_filter_reduced is not None and self.pre_filter_reduced < 1:
+            raise InvalidInputError("pre_filter_reduced must be at least 1")
+
 
 def request_handler(input: QueryInput) -> bytes:
     d, model, ann_idx = datasets[input.dataset]
@@ -255,6 +437,33 @@ def request_handler(input: QueryInput) -> bytes:
             raw.drop(columns=cols, inplace=True)
             # This is why we index "id" in `d.table`.
             df = df.merge(raw, how="inner", on="id")
+        elif input.pre_filter_clusters is not None:
+            if d.ivf_offsets is None:
+                raise ValueError("Dataset is not clustered")
+            # Shape (clusters, query_count).
+            c_sims = d.ivf_centroids @ q_mat.T
+            top = xp.argsort(-c_sims, axis=0)[: input.pre_filter_clusters]
+            # Sorted, so we read the matrix and table in order.
+            clusters = xp.unique(top).tolist()
+            ranges = [(d.ivf_offsets[c], d.ivf_offsets[c + 1]) for c in clusters]
+            # Multiply each cluster's contiguous block of rows directly, instead of gathering the rows into a copy first.
+            mat_sims = xp.concatenate(
+                [d.emb_mat[start:end] @ q_mat.T for start, end in ranges]
+            )
+            df = df.iloc[
+                xp.concatenate([xp.arange(start, end) for start, end in ranges])
+            ]
+        elif input.pre_filter_reduced is not None:
+            if d.reduced_mat is None:
+                raise ValueError("Dataset does not have reduced embeddings")
+            n = min(input.pre_filter_reduced, len(df))
+            approx = getattr(xp, input.sim_agg)(
+                d.reduced_mat @ (q_mat @ d.reduced_proj).T, axis=1
+            )
+            # Sorted, so we read the matrix and table in order.
+            rows = xp.sort(xp.argpartition(-approx, n - 1)[:n])
+            mat_sims = d.emb_mat[rows] @ q_mat.T
+            df = df.iloc[rows]
         else:
             mat_sims = d.emb_mat @ q_mat.T
 
@@ -323,9 +532,11 @@ class BrokerMessage:
 
 
 def on_message(ws, raw):
-    msg = BrokerMessage.from_json(raw)
+    # Parse the ID separately, so that we can still respond if the input is invalid.
+    msg_id = json.loads(raw)["id"]
 
     try:
+        msg = BrokerMessage.from_json(raw)
         res = {
             "output": request_handler(msg.input),
         }
@@ -344,7 +555,7 @@ def on_message(ws, raw):
     ws.send(
         msgpack.packb(
             {
-                "id": msg.id,
+                "id": msg_id,
                 **res,
             }
         ),
@@ -359,25 +570,27 @@ def on_open(ws):
     ws.send(init_req, opcode=websocket.ABNF.OPCODE_BINARY)
 
 
-public_ip = requests.get("https://icanhazip.com").text.strip()
-print("Public IP:", public_ip)
-
-datasets = load_data()
-print("All data loaded!")
-
-websocket.setdefaulttimeout(30)
-wsapp = websocket.WebSocketApp(
-    "wss://api-worker-broker.hndr.wilsonl.in:6000",
-    on_error=on_error,
-    on_message=on_message,
-    on_open=on_open,
-)
-print("Started listener")
-with open("/tmp/cert.pem", "wb") as f:
-    f.write(base64.standard_b64decode(env("API_WORKER_NODE_CERT_B64")))
-wsapp.run_forever(
-    reconnect=30,
-    sslopt={
-        "ca_certs": "/tmp/cert.pem",
-    },
-)
+# Guarded so that the query engine can be imported by tests without connecting to anything.
+if __name__ == "__main__":
+    public_ip = requests.get("https://icanhazip.com").text.strip()
+    print("Public IP:", public_ip)
+
+    datasets = load_data()
+    print("All data loaded!")
+
+    websocket.setdefaulttimeout(30)
+    wsapp = websocket.WebSocketApp(
+        "wss://api-worker-broker.hndr.wilsonl.in:6000",
+        on_error=on_error,
+        on_message=on_message,
+        on_open=on_open,
+    )
+    print("Started listener")
+    with open("/tmp/cert.pem", "wb") as f:
+        f.write(base64.standard_b64decode(env("API_WORKER_NODE_CERT_B64")))
+    wsapp.run_forever(
+        reconnect=30,
+        sslopt={
+            "ca_certs": "/tmp/cert.pem",
+        },
+    )
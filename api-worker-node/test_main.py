@@ -0,0 +1,135 @@
+from types import SimpleNamespace
+import importlib.util
+import msgpack
+import numpy as np
+import os
+import pandas as pd
+import pytest
+import struct
+
+os.environ.setdefault("API_WORKER_NODE_TOKEN", "test")
+os.environ["API_WORKER_NODE_USE_GPU"] = "0"
+# The directory name isn't a valid package name, so import the file directly.
+_spec = importlib.util.spec_from_file_location(
+    "api_worker_node_main", os.path.join(os.path.dirname(__file__), "main.py")
+)
+assert _spec is not None and _spec.loader is not None
+worker = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(worker)
+
+USERS = np.array([f"user{i}" for i in range(20)], dtype=object)
+
+
+def make_df(rows: int = 2000):
+    rng = np.random.default_rng(0)
+    sent = rng.random(rows).astype(np.float32)
+    sent[rng.random(rows) < 0.2] = np.nan
+    # Every row of user 3 is NaN, so its min/max/mean are NaN.
+    users = rng.integers(0, 15, rows).astype(np.uint8)
+    sent[users == 3] = np.nan
+    return pd.DataFrame(
+        {
+            "user": users,
+            "ts_day": rng.uniform(19000, 19100, rows).astype(np.float32),
+            "final_score": rng.random(rows).astype(np.float32),
+            "sent": sent,
+            "votes": rng.integers(-5, 300, rows).astype(np.int16),
+            "kids": rng.integers(0, 200, rows).astype(np.uint8),
+            "flag": rng.random(rows) < 0.5,
+        }
+    )
+
+
+def unpack_rows(raw: bytes, cols: int):
+    # The inverse of pack_rows.
+    (count,) = struct.unpack_from("<I", raw)
+    pos = 4
+    out = []
+    for _ in range(cols):
+        kind = chr(raw[pos])
+        pos += 1
+        if kind == "O":
+            (size,) = struct.unpack_from("<I", raw, pos)
+            out.append(msgpack.unpackb(raw[pos + 4 : pos + 4 + size]))
+            pos += 4 + size
+        else:
+            size = raw[pos] * count
+            out.append(
+                np.frombuffer(raw[pos + 1 : pos + 1 + size], dtype=f"<{kind}{raw[pos]}")
+            )
+            pos += 1 + size
+    assert pos == len(raw)
+    return out
+
+
+def assert_same_output(a: bytes, b: bytes, cols: int):
+    for x, y in zip(unpack_rows(a, cols), unpack_rows(b, cols), strict=True):
+        if isinstance(x, list):
+            assert x == y
+        else:
+            assert x.dtype == y.dtype
+            # Summation order differs, so floats may differ slightly.
+            np.testing.assert_allclose(x, y, rtol=1e-5)
+
+
+COLS = [
+    (("final_score", agg), ("sent", agg), ("votes", agg), ("kids", agg))
+    for agg in worker.FAST_GROUP_BY_AGGS
+]
+
+
+@pytest.mark.parametrize("cols", COLS)
+@pytest.mark.parametrize("order_by", ["group", "final_score"])
+def test_dict_group_by_matches_generic(cols, order_by):
+    d = SimpleNamespace(dicts={"user": USERS})
+    df = make_df()
+    if order_by != "group" and cols[0][1] == "count":
+        pytest.skip("Ties in the order column have no defined order")
+    g = worker.GroupByOutput(by="user", cols=cols, order_by=order_by, limit=10)
+    assert_same_output(g.calculate(d, df), g.calculate_generic(d, df), len(cols) + 1)
+
+
+@pytest.mark.parametrize("cols", COLS)
+def test_bucketed_group_by_matches_generic(cols):
+    d = SimpleNamespace(dicts={})
+    df = make_df()
+    g = worker.GroupByOutput(by="ts_day", bucket=7, cols=cols)
+    assert_same_output(g.calculate(d, df), g.calculate_generic(d, df), len(cols) + 1)
+
+
+@pytest.mark.parametrize("agg", worker.FAST_GROUP_BY_AGGS)
+def test_bool_columns_use_fast_group_by(agg, monkeypatch):
+    # The `*_thresh` columns are bools.
+    d = SimpleNamespace(dicts={"user": USERS})
+    df = make_df()
+    g = worker.GroupByOutput(by="user", cols=(("flag", agg),))
+    expected = g.calculate_generic(d, df)
+    monkeypatch.setattr(worker.GroupByOutput, "calculate_generic", None)
+    assert_same_output(g.calculate(d, df), expected, 2)
+
+
+@pytest.mark.parametrize("order_asc", [True, False])
+@pytest.mark.parametrize("agg", ["mean", "min", "max"])
+def test_nan_groups_are_ordered_last(agg, order_asc):
+    d = SimpleNamespace(dicts={"user": USERS})
+    df = make_df()
+    g = worker.GroupByOutput(
+        by="user", cols=(("sent", agg),), order_by="sent", order_asc=order_asc
+    )
+    out = g.calculate(d, df)
+    assert_same_output(out, g.calculate_generic(d, df), 2)
+    assert np.isnan(unpack_rows(out, 2)[1][-1])
+
+
+@pytest.mark.parametrize("col", ["sent", "votes", "kids", "flag"])
+@pytest.mark.parametrize("agg", ["count", "sum", "mean", "min", "max"])
+def test_agg_by_codes_matches_pandas(col, agg):
+    df = make_df()
+    codes = df["user"].to_numpy().astype(np.int64)
+    n = USERS.shape[0]
+    counts = np.bincount(codes, minlength=n)
+    present = np.flatnonzero(counts)
+    fast = worker.agg_by_codes(codes, df[col].to_numpy(), agg, n, counts)[present]
+    expected = df.groupby("user")[col].agg(agg)
+    assert fast.dtype == expected.dtype
+    np.testing.assert_allclose(fast, expected.to_numpy(), rtol=1e-5)
@@ -1,16 +1,61 @@
 from common.data import ApiDataset
+from common.data import append_mmap_matrix_rows
+from common.data import dump_mmap_matrix
+from common.data import dump_mmap_matrix_rows
+from common.data import join_sorted_ids
+from common.data import load_arrow_table
 from common.data import load_embs_as_table
+from common.data import load_mmap_matrix
+from common.data import load_numpy_columns
 from common.data import load_table
-from common.data import load_umap
+from common.data import merge_on_unique
+from common.emb_data import load_umap
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Callable
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Tuple
+import json
 import multiprocessing
 import numpy as np
+import os
 import pandas as pd
+import pyarrow
 
+# If enabled, existing api datasets are updated in place instead of rebuilt from scratch: new items are appended to the table and embedding matrix, and changing columns are patched. Datasets whose source files haven't changed since the last build are skipped entirely.
+INCREMENTAL = os.getenv("BUILD_API_DATA_INCREMENTAL", "0") == "1"
 
-def normalize_dataset(df: pd.DataFrame, mat_embs: np.ndarray):
-    # This may be smaller than the original, if some rows have been filtered during inner joins.
-    mat_embs_ordered = mat_embs[df.pop("emb_row").to_numpy()]
+# Columns of existing rows that can change between builds (e.g. as the crawler updates items). All other columns are assumed to be fixed once an item exists.
+PATCH_COLUMNS = ("votes", "votes_norm", "comment_count")
 
+# String columns that are stored as integer codes into a separate dictionary. This makes the table smaller, and allows the API worker to group by them much faster.
+DICT_COLUMNS = ("user",)
+
+
+def parse_dataset_ints(var: str) -> Dict[str, int]:
+    # Parses e.g. "toppost=256,post=1024".
+    return {
+        name: int(v)
+        for name, v in (e.split("=") for e in os.getenv(var, "").split(",") if e)
+    }
+
+
+# Map from dataset to the k of its k-means clustering (from the kmeans script) to add as the `cluster` column, e.g. "toppost=256,post=1024". Rows of these datasets are stored grouped by cluster, along with the centroids, which lets the API worker search only the clusters closest to the query.
+CLUSTERS = parse_dataset_ints("BUILD_API_DATA_CLUSTERS")
+# Maximum bytes for each chunk's (rows, k) similarity matrix when assigning unclustered rows.
+CLUSTER_SIMS_BUFSIZE = 256 * 1024 * 1024
+
+# Map from dataset to the number of dimensions of its reduced embedding matrix, e.g. "toppost=256,post=128". The API worker can scan the much smaller reduced matrix first, then rerank the top rows using the full embeddings.
+REDUCED_DIMS = parse_dataset_ints("BUILD_API_DATA_REDUCED_DIMS")
+# How many rows to sample when fitting the reduction.
+REDUCE_SAMPLE = 200_000
+# Maximum bytes of embedding rows to project at once.
+REDUCE_BUFSIZE = 1024 * 1024 * 1024
+
+
+def normalize_table(df: pd.DataFrame):
     score_min = df["score"].min()
     score_max = df["score"].max()
     # Call this "votes" to avoid confusion with the "score" that we assign.
@@ -22,105 +67,431 @@ def normalize_dataset(df: pd.DataFrame, mat_embs: np.ndarray):
     df["ts"] = df["ts"].astype("int64")
     df["ts_day"] = df["ts"] / (60 * 60 * 24)
     df.set_index("id", inplace=True)
+    return df
+
 
+def dict_encode(df: pd.DataFrame, dicts: Dict[str, np.ndarray]):
+    # Existing codes never change, so that incremental updates can just append new values to the dictionary.
+    for c in DICT_COLUMNS:
+        if c not in df:
+            continue
+        values = pd.Index(dicts.get(c, np.empty(0, dtype=object)))
+        values = values.append(pd.Index(df[c].unique()).difference(values))
+        df[c] = values.get_indexer(df[c])
+        dicts[c] = values.to_numpy(dtype=object)
+    return df
+
+
+def compact_table(df: pd.DataFrame):
+    # The API worker memory maps the table and scans entire columns for every query, so use the narrowest dtypes possible.
+    for c in df.columns:
+        col = df[c]
+        kind = col.dtype.kind
+        if kind == "f":
+            # Nothing we use requires more than float32 precision (e.g. ts_day is precise to within a few minutes).
+            df[c] = col.astype(np.float32)
+        elif kind in "iu" and len(col):
+            # This picks the smallest signed or unsigned integer type that can hold both values.
+            dt = np.result_type(
+                np.min_scalar_type(col.min()), np.min_scalar_type(col.max())
+            )
+            df[c] = col.astype(dt)
+    return df
+
+
+def calc_meta(df: pd.DataFrame):
     if "x" in df and "y" in df:
-        meta = {
+        return {
             "x_max": df["x"].max().item(),
             "x_min": df["x"].min().item(),
             "y_max": df["y"].max().item(),
             "y_min": df["y"].min().item(),
         }
+    return {}
+
+
+def emb_sources(name: str):
+    return [f"{name}-embs-ids.mat", f"{name}-embs-data.mat"]
+
+
+def cluster_sources(name: str, k: int):
+    return [f"kmeans-{name}/k{k}_cluster.arrow", f"kmeans-{name}/k{k}.json"]
+
+
+def group_by_cluster(
+    name: str, k: int, df: pd.DataFrame, mat_emb: np.ndarray, emb_rows: np.ndarray
+):
+    with open(f"/hndr-data/kmeans-{name}/k{k}.json") as f:
+        centroids = np.array(json.load(f)["cluster_centers"], dtype=np.float32)
+    # MiniBatchKMeans centroids aren't unit vectors, but the API worker ranks them by dot product like the rows.
+    centroids /= np.maximum(np.linalg.norm(centroids, axis=1, keepdims=True), 1e-12)
+    cluster_cols = load_numpy_columns(
+        f"kmeans-{name}/k{k}_cluster", ["id", f"k{k}_cluster"]
+    )
+    left_rows, right_rows = join_sorted_ids(df.index.to_numpy(), cluster_cols["id"])
+    clusters = np.full(len(df), -1, dtype=np.int64)
+    clusters[left_rows] = cluster_cols[f"k{k}_cluster"][right_rows]
+    # Rows added since the clustering was computed are assigned to their nearest centroid, so that no row is unreachable.
+    missing = np.flatnonzero(clusters < 0)
+    print(f"Assigning {len(missing)} unclustered rows to their nearest centroid")
+    chunk_rows = max(1, CLUSTER_SIMS_BUFSIZE // (k * 4))
+    for start in range(0, len(missing), chunk_rows):
+        rows = missing[start : start + chunk_rows]
+        sims = mat_emb[emb_rows[rows]] @ centroids.T
+        clusters[rows] = sims.argmax(axis=1)
+
+    order = np.argsort(clusters, kind="stable")
+    clusters = clusters[order]
+    df = df.iloc[order].assign(cluster=clusters)
+    offsets = np.searchsorted(clusters, np.arange(k + 1)).tolist()
+    return df, emb_rows[order], centroids, offsets
+
+
+def get_source_versions(sources: List[str]):
+    out = {}
+    for src in sources:
+        st = os.stat(f"/hndr-data/{src}")
+        out[src] = [st.st_size, st.st_mtime_ns]
+    return out
+
+
+def load_manifest(name: str) -> Optional[dict]:
+    try:
+        with open(f"/hndr-data/api-{name}-manifest.json") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def get_build_config(name: str):
+    # Everything besides the sources that affects the built dataset, so that changing it isn't mistaken for the dataset being up to date.
+    return {
+        "clusters": CLUSTERS.get(name),
+        "reduced_dims": REDUCED_DIMS.get(name),
+        "reduce_sample": REDUCE_SAMPLE,
+        "dict_columns": list(DICT_COLUMNS),
+        "patch_columns": list(PATCH_COLUMNS),
+    }
+
+
+def dump_manifest(name: str, versions: Dict[str, List[int]], config: dict):
+    with open(f"/hndr-data/api-{name}-manifest.json", "w") as f:
+        json.dump({"sources": versions, "config": config}, f)
+
+
+def fit_projection(mat: np.ndarray, dims: int):
+    rng = np.random.default_rng(0)
+    rows = np.sort(
+        rng.choice(mat.shape[0], min(mat.shape[0], REDUCE_SAMPLE), replace=False)
+    )
+    sample = np.asarray(mat[rows], dtype=np.float64)
+    # This is PCA without centering the rows. We want to preserve dot products with queries, not variance around the mean, and the top eigenvectors of the uncentered second moment matrix span the subspace that best preserves them. (Our embedding models aren't Matryoshka trained, so simply truncating the vectors would lose much more.)
+    eigvals, eigvecs = np.linalg.eigh(sample.T @ sample)
+    # eigh returns eigenvalues in ascending order.
+    top = np.argsort(eigvals)[::-1][:dims]
+    kept = eigvals[top].sum() / eigvals.sum()
+    print(f"Reduced to {dims} dims, keeping {kept * 100:.2f}% of energy")
+    return eigvecs[:, top].astype(np.float32)
+
+
+def build_reduced(name: str, count: int, emb_dim: int, start: int = 0):
+    """
+    Writes the reduced embeddings for rows [start, count) of the dataset, appending to the existing reduced matrix if `start` is nonzero and the existing projection can be reused. Returns (reduced_mat, reduced_proj), which are None if the dataset isn't configured to be reduced.
+    """
+    dims = REDUCED_DIMS.get(name)
+    if dims is None:
+        return None, None
+    mat = load_mmap_matrix(f"api-{name}-emb", (count, emb_dim), np.float32)
+    proj_path = f"/hndr-data/api-{name}-emb-proj.mat"
+    reduced_path = f"/hndr-data/api-{name}-emb-reduced.mat"
+    can_append = (
+        start
+        and os.path.exists(proj_path)
+        and os.path.getsize(proj_path) == emb_dim * dims * 4
+        and os.path.exists(reduced_path)
+        and os.path.getsize(reduced_path) == start * dims * 4
+    )
+    if can_append:
+        proj = load_mmap_matrix(f"api-{name}-emb-proj", (emb_dim, dims), np.float32)
     else:
-        meta = {}
+        start = 0
+        proj = fit_projection(mat, dims)
+        dump_mmap_matrix(f"api-{name}-emb-proj", proj)
+    chunk_rows = max(1, REDUCE_BUFSIZE // (emb_dim * 4))
+    with open(reduced_path, "ab" if start else "wb") as f:
+        for chunk_start in range(start, count, chunk_rows):
+            chunk = np.asarray(mat[chunk_start : chunk_start + chunk_rows])
+            f.write((chunk @ proj).tobytes())
+    return (
+        load_mmap_matrix(f"api-{name}-emb-reduced", (count, dims), np.float32),
+        load_mmap_matrix(f"api-{name}-emb-proj", (emb_dim, dims), np.float32),
+    )
+
 
-    return df, mat_embs_ordered, meta
+def update_dataset(name: str, df: pd.DataFrame, mat_embs: np.ndarray):
+    old = ApiDataset.load(name)
+    # Make a deep copy, as the loaded table is memory mapped from the file we're about to overwrite.
+    table = old.table.copy(deep=True)
+    emb_dim = old.emb_mat.shape[1]
+    old_count = len(table)
+    dicts = old.dicts
+    del old
 
+    # Decide by membership rather than by comparing IDs to the previous maximum, as a row with a lower ID can become joinable later (e.g. its embedding or sentiment arrives after higher IDs were built).
+    is_new = ~df["id"].isin(table.index).to_numpy()
+    # Only the embeddings of new rows are read and appended, so we avoid reordering and rewriting the entire matrix.
+    new_emb_rows = df.pop("emb_row").to_numpy()[is_new]
 
-def merge_comment_count(df: pd.DataFrame):
-    df_comments = (
-        load_table("comments", columns=["id", "post"])
-        .groupby("post")
-        .size()
-        .reset_index(name="comment_count")
+    df = dict_encode(normalize_table(df), dicts)
+
+    common_ids = table.index.intersection(df.index)
+    for c in PATCH_COLUMNS:
+        if c in table:
+            # The existing column may have been compacted to a dtype too narrow for the new values.
+            table[c] = table[c].astype(df[c].dtype)
+            table.loc[common_ids, c] = df.loc[common_ids, c]
+    df_new = df[is_new]
+    print(f"Patched {len(common_ids)} existing rows, appending {len(df_new)} new rows")
+    table = compact_table(pd.concat([table, df_new[table.columns]]))
+
+    # Append the embeddings before writing the table and meta, so a failure never leaves a table pointing at rows that don't exist. Rows left over from a failed run are past `old_count`, so they're overwritten.
+    append_mmap_matrix_rows(f"api-{name}-emb", mat_embs, new_emb_rows, old_count)
+    reduced_mat, reduced_proj = build_reduced(name, len(table), emb_dim, old_count)
+    dump_table_and_meta(
+        name,
+        table,
+        emb_dim,
+        dicts,
+        reduced_mat=reduced_mat,
+        reduced_proj=reduced_proj,
     )
-    df = df.merge(df_comments, left_on="id", right_on="post", how="left")
-    df["comment_count"] = df["comment_count"].fillna(0)
-    return df
+    return table
+
+
+def dump_table_and_meta(
+    name: str,
+    table: pd.DataFrame,
+    emb_dim: int,
+    dicts: Dict[str, np.ndarray],
+    ivf_centroids: Optional[np.ndarray] = None,
+    ivf_offsets: Optional[List[int]] = None,
+    reduced_mat: Optional[np.ndarray] = None,
+    reduced_proj: Optional[np.ndarray] = None,
+):
+    d = ApiDataset(
+        name=name,
+        table=table,
+        emb_mat=load_mmap_matrix(f"api-{name}-emb", (len(table), emb_dim), np.float32),
+        dicts=dicts,
+        ivf_centroids=ivf_centroids,
+        ivf_offsets=ivf_offsets,
+        reduced_mat=reduced_mat,
+        reduced_proj=reduced_proj,
+        **calc_meta(table),
+    )
+    d.dump_table()
+    d.dump_meta()
+
+
+def build_dataset(
+    name: str,
+    sources: List[str],
+    load_data: Callable[[], Tuple[pd.DataFrame, np.ndarray]],
+):
+    k = CLUSTERS.get(name)
+    if k is not None:
+        if not os.path.exists(f"/hndr-data/kmeans-{name}/k{k}.json"):
+            raise ValueError(
+                f"Dataset {name} is configured with {k} clusters, but there is no k-means result for it; run kmeans with KMEANS_DATASET={name} and a range that includes k={k}"
+            )
+        sources = [*sources, *cluster_sources(name, k)]
+    versions = get_source_versions(sources)
+    config = get_build_config(name)
+    manifest = load_manifest(name) if INCREMENTAL else None
+    if (
+        manifest is not None
+        and manifest["sources"] == versions
+        and manifest.get("config") == config
+    ):
+        print(f"Dataset {name} is up to date, skipping")
+        return
+    if manifest is not None and (
+        # Appending rows would break the grouping by cluster.
+        k is not None
+        # The existing table, dictionaries, or reduced embeddings may have been built differently.
+        or manifest.get("config") != config
+        # The columns may have changed, e.g. the dataset was previously clustered.
+        or manifest["sources"].keys() != versions.keys()
+    ):
+        print(f"Dataset {name} can't be updated in place, rebuilding from scratch")
+        manifest = None
+
+    df, mat_emb = load_data()
+    if manifest is not None:
+        df = update_dataset(name, df, mat_emb)
+    else:
+        # This may be fewer rows than the original, if some rows have been filtered during inner joins.
+        emb_rows = df.pop("emb_row").to_numpy()
+        dicts = {}
+        df = dict_encode(normalize_table(df), dicts)
+        ivf_centroids = None
+        ivf_offsets = None
+        if k is not None:
+            df, emb_rows, ivf_centroids, ivf_offsets = group_by_cluster(
+                name, k, df, mat_emb, emb_rows
+            )
+        df = compact_table(df)
+        # Don't use `mat_emb[emb_rows]`, as that would materialise the entire reordered matrix in memory before it's copied again to the output file.
+        dump_mmap_matrix_rows(f"api-{name}-emb", mat_emb, emb_rows)
+        reduced_mat, reduced_proj = build_reduced(name, len(df), mat_emb.shape[1])
+        dump_table_and_meta(
+            name,
+            df,
+            mat_emb.shape[1],
+            dicts,
+            ivf_centroids,
+            ivf_offsets,
+            reduced_mat,
+            reduced_proj,
+        )
+    print(f"Dataset {name}:", len(df))
+    dump_manifest(name, versions, config)
+
+
+@dataclass
+class SharedData:
+    # Posts with their comment count, used by both post datasets.
+    posts: pd.DataFrame
+    comments: pyarrow.Table
 
 
-def build_post_data():
-    df = load_table("posts", columns=["id", "score", "ts"])
-    df = merge_comment_count(df)
+def load_shared_data():
+    # These are needed by more than one dataset, so load them once in the parent process before forking the dataset builders (which then share the memory), instead of each builder re-reading the same multi-GB tables.
+    print("Loading posts and comments")
+    with ThreadPoolExecutor() as pool:
+        f_posts = pool.submit(load_arrow_table, "posts", ["id", "score", "ts"])
+        f_comments = pool.submit(
+            load_arrow_table, "comments", ["id", "post", "author", "score", "ts"]
+        )
+        posts = f_posts.result()
+        comments = f_comments.result()
+    print("Calculating comment counts")
+    # Use Arrow's group by and join, which are multithreaded and much faster than pandas.
+    comment_counts = (
+        comments.group_by("post")
+        .aggregate([("id", "count")])
+        .rename_columns({"id_count": "comment_count"})
+    )
+    posts = posts.join(
+        comment_counts, keys="id", right_keys="post", join_type="left outer"
+    ).to_pandas()
+    # Posts without comments are NaN after the left join, which makes the column float64; convert it back to integers.
+    posts["comment_count"] = posts["comment_count"].fillna(0).astype(np.int64)
+    return SharedData(
+        posts=posts,
+        comments=comments.select(["id", "author", "score", "ts"]),
+    )
+
+
+def load_post_data(shared: SharedData):
     df_embs, mat_emb = load_embs_as_table("post")
-    df = df.merge(df_embs, on="id", how="inner")
-    df, mat_emb, meta = normalize_dataset(df, mat_emb)
-    print("Posts:", len(df))
-    ApiDataset(
-        name="post",
-        emb_mat=mat_emb,
-        table=df,
-        **meta,
-    ).dump()
-
-
-def build_toppost_data():
-    df = load_table("posts", columns=["id", "score", "ts"])
-    df = merge_comment_count(df)
-    df_embs, mat_emb = load_embs_as_table("toppost")
-    df = df.merge(df_embs, on="id", how="inner")
-    df = df.merge(load_umap("toppost"), on="id", how="inner")
-    df, mat_emb, meta = normalize_dataset(df, mat_emb)
-    print("Posts bgem3:", len(df))
-    ApiDataset(
-        name="toppost",
-        emb_mat=mat_emb,
-        table=df,
-        **meta,
-    ).dump()
-
-
-def load_comment_data():
-    print("Loading comments")
-    df = load_table("comments", columns=["id", "author", "score", "ts"]).rename(
-        columns={"author": "user_id"}
+    df = merge_on_unique(shared.posts, df_embs, "id")
+    return df, mat_emb
+
+
+def build_post_data(shared: SharedData):
+    build_dataset(
+        "post",
+        ["posts.arrow", "comments.arrow", *emb_sources("post")],
+        lambda: load_post_data(shared),
     )
-    print("Loading and merging users")
-    df_users = load_table("users").rename(columns={"id": "user_id", "username": "user"})
-    df = df.merge(df_users, how="inner", on="user_id")
-    print("Loading and merging comment embeddings")
-    df_embs, mat_emb = load_embs_as_table("comment")
-    df = df.merge(df_embs, on="id", how="inner")
-    print("Loading and merging comment sentiments")
-    df_sent = load_table("comment_sentiments").rename(
-        columns={
-            "positive": "sent_pos",
-            "neutral": "sent_neu",
-            "negative": "sent_neg",
-        }
+
+
+def load_toppost_data(shared: SharedData):
+    with ThreadPoolExecutor() as pool:
+        f_embs = pool.submit(load_embs_as_table, "toppost")
+        f_umap = pool.submit(load_umap, "toppost")
+        df_embs, mat_emb = f_embs.result()
+        df_umap = f_umap.result()
+    df = merge_on_unique(shared.posts, df_embs, "id")
+    df = merge_on_unique(df, df_umap, "id")
+    return df, mat_emb
+
+
+def build_toppost_data(shared: SharedData):
+    build_dataset(
+        "toppost",
+        [
+            "posts.arrow",
+            "comments.arrow",
+            *emb_sources("toppost"),
+            "ann-toppost-ids.mat",
+            "umap-toppost-emb.mat",
+        ],
+        lambda: load_toppost_data(shared),
     )
-    df = df.merge(df_sent, on="id", how="inner")
+
+
+def load_comment_data(shared: SharedData):
+    print("Loading users, comment embeddings, and comment sentiments")
+    # These are all independent, and reading them mostly releases the GIL, so load them concurrently.
+    with ThreadPoolExecutor() as pool:
+        f_users = pool.submit(load_table, "users")
+        f_embs = pool.submit(load_embs_as_table, "comment")
+        f_sent = pool.submit(load_table, "comment_sentiments")
+        df = shared.comments.to_pandas().rename(columns={"author": "user_id"})
+        print("Merging users")
+        df_users = f_users.result().rename(
+            columns={"id": "user_id", "username": "user"}
+        )
+        df = merge_on_unique(df, df_users, "user_id")
+        print("Merging comment embeddings")
+        df_embs, mat_emb = f_embs.result()
+        df = merge_on_unique(df, df_embs, "id")
+        print("Merging comment sentiments")
+        df_sent = f_sent.result().rename(
+            columns={
+                "positive": "sent_pos",
+                "neutral": "sent_neu",
+                "negative": "sent_neg",
+            }
+        )
+    df = merge_on_unique(df, df_sent, "id")
     print("Calculating derived comment sentiment columns")
-    df["sent"] = np.float32(0.0)
-    df.loc[df["sent_neg"] > df[["sent_neu", "sent_pos"]].max(axis=1), "sent"] = -df[
-        "sent_neg"
-    ]
-    df.loc[df["sent_pos"] > df["sent_neu"], "sent"] = df["sent_pos"]
-    print("Normalizing comment table")
-    df, mat_emb, meta = normalize_dataset(df, mat_emb)
-    print("Comments:", len(df))
-    ApiDataset(
-        name="comment",
-        emb_mat=mat_emb,
-        table=df,
-        **meta,
-    ).dump()
+    pos = df["sent_pos"].to_numpy()
+    neu = df["sent_neu"].to_numpy()
+    neg = df["sent_neg"].to_numpy()
+    # Positive if it's more positive than neutral, otherwise negative if it's the most negative, otherwise zero.
+    df["sent"] = np.where(
+        pos > neu,
+        pos,
+        np.where(neg > np.maximum(neu, pos), -neg, np.float32(0.0)),
+    ).astype(np.float32)
+    return df, mat_emb
+
+
+def build_comment_data(shared: SharedData):
+    build_dataset(
+        "comment",
+        [
+            "comments.arrow",
+            "users.arrow",
+            "comment_sentiments.arrow",
+            *emb_sources("comment"),
+        ],
+        lambda: load_comment_data(shared),
+    )
 
 
 if __name__ == "__main__":
+    shared = load_shared_data()
+
     # Create processes for each function
-    p1 = multiprocessing.Process(target=build_post_data)
-    p2 = multiprocessing.Process(target=build_toppost_data)
-    p3 = multiprocessing.Process(target=load_comment_data)
+    # We rely on the "fork" start method, so that `shared` is inherited instead of pickled.
+    ctx = multiprocessing.get_context("fork")
+    p1 = ctx.Process(target=build_post_data, args=(shared,))
+    p2 = ctx.Process(target=build_toppost_data, args=(shared,))
+    p3 = ctx.Process(target=build_comment_data, args=(shared,))
 
     # Start each process
     p1.start()
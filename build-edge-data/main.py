@@ -1,16 +1,31 @@
+from common.data import clear_table_cache
 from common.data import load_table
-from common.data import load_umap
+from common.data import load_table_cached
+from common.emb_data import load_umap
+import json
 import msgpack
+import numpy as np
+import os
+import pandas as pd
+import pyarrow
+import pyarrow.ipc
 
+# "msgpack" writes everything as one blob `edge.msgpack`. "arrow" writes columnar Arrow IPC files into `edge/`, partitioned and indexed so that a single item can be looked up without loading everything.
+FORMAT = os.getenv("EDGE_DATA_FORMAT", "msgpack")
+# Each posts partition contains the IDs in [n * PARTITION_IDS, (n + 1) * PARTITION_IDS).
+PARTITION_IDS = int(os.getenv("EDGE_DATA_PARTITION_IDS", "1000000"))
+# Rows per Arrow record batch. A lookup only needs to read the one batch containing the key.
+BATCH_ROWS = int(os.getenv("EDGE_DATA_BATCH_ROWS", "4096"))
 
-def load_umap_as_dict(dataset: str):
+OUT_DIR = "/hndr-data/edge"
+
+
+def load_umap_table(dataset: str):
     print("Loading UMAP:", dataset)
-    df = load_umap("toppost")
-    df.set_index("id", inplace=True)
-    return df.to_dict("index")
+    return load_umap(dataset)
 
 
-def load_posts():
+def load_posts_table():
     print("Loading posts")
     df = load_table("posts", columns=["id", "author", "score", "ts", "url"]).rename(
         columns={"author": "author_id", "url": "url_id"}
@@ -20,7 +35,8 @@ def load_posts():
         columns={"id": "author_id", "username": "author"}
     )
     df = df.merge(df_users, on="author_id", how="inner").drop(columns=["author_id"])
-    df_urls = load_table(
+    # The urls table is huge and also needed by load_url_metas_table, so keep it in memory instead of reading it again.
+    df_urls = load_table_cached(
         "urls", columns=["id", "url", "proto", "found_in_archive"]
     ).rename(columns={"id": "url_id"})
     df = df.merge(df_urls, on="url_id", how="left").drop(columns=["url_id"])
@@ -29,19 +45,21 @@ def load_posts():
     df.loc[df["found_in_archive"].isna(), "found_in_archive"] = False
     df_titles = load_table("post_titles").rename(columns={"text": "title"})
     df = df.merge(df_titles, on="id", how="inner")
-    df = df.set_index("id")
-    return df.to_dict("index")
+    return df
 
 
-def load_url_metas():
+def load_url_metas_table():
     print("Loading URL metas")
     df = load_table("url_metas").rename(columns={"id": "url_id"})
     df["timestamp"] = df["timestamp"].astype("int64")
     df["timestamp_modified"] = df["timestamp_modified"].astype("int64")
-    df_urls = load_table("urls", columns=["id", "url"]).rename(columns={"id": "url_id"})
+    df_urls = load_table_cached("urls", columns=["id", "url"]).rename(
+        columns={"id": "url_id"}
+    )
+    # This is the last use of the cached urls table.
+    clear_table_cache()
     df = df.merge(df_urls, on="url_id", how="inner").drop(columns=["url_id"])
-    df = df.set_index("url")
-    return df.to_dict("index")
+    return df
 
 
 def load_map_data(dataset: str):
@@ -52,19 +70,93 @@ def load_map_data(dataset: str):
     return data
 
 
-out = {
-    "maps": {
-        dataset: {
-            "points": load_umap_as_dict(dataset),
-            **load_map_data(dataset),
+# Set to e.g. "toppost,post" to export multiple maps in one run, once they are built.
+MAP_DATASETS = os.getenv("EDGE_DATA_MAPS", "toppost").split(",")
+
+
+def build_msgpack():
+    out = {
+        "maps": {
+            dataset: {
+                "points": load_umap_table(dataset).set_index("id").to_dict("index"),
+                **load_map_data(dataset),
+            }
+            for dataset in MAP_DATASETS
+        },
+        "posts": load_posts_table().set_index("id").to_dict("index"),
+        "url_metas": load_url_metas_table().set_index("url").to_dict("index"),
+    }
+    print("Packing")
+    with open("/hndr-data/edge.msgpack", "wb") as f:
+        msgpack.dump(out, f)
+
+
+def write_sorted_arrow(name: str, df: pd.DataFrame, key: str):
+    """
+    Writes `df`, which must be sorted by `key`, as an Arrow IPC file of BATCH_ROWS-sized record batches, and returns an index of the first and last key of each batch.
+    The writer streams one batch at a time, so we never build a second full copy of the table.
+    """
+    schema = pyarrow.Schema.from_pandas(df, preserve_index=False)
+    batches = []
+    with pyarrow.ipc.new_file(f"{OUT_DIR}/{name}.arrow.tmp", schema) as w:
+        for start in range(0, len(df), BATCH_ROWS):
+            chunk = df.iloc[start : start + BATCH_ROWS]
+            w.write_batch(
+                pyarrow.RecordBatch.from_pandas(
+                    chunk, schema=schema, preserve_index=False
+                )
+            )
+            batches.append(chunk[key].iloc[[0, -1]].tolist())
+    os.rename(f"{OUT_DIR}/{name}.arrow.tmp", f"{OUT_DIR}/{name}.arrow")
+    return {"file": f"{name}.arrow", "rows": len(df), "batches": batches}
+
+
+def build_arrow():
+    os.makedirs(OUT_DIR, exist_ok=True)
+    index = {
+        "partition_ids": PARTITION_IDS,
+        "batch_rows": BATCH_ROWS,
+        "maps": {},
+        "posts": {},
+    }
+
+    for dataset in MAP_DATASETS:
+        df = load_umap_table(dataset).sort_values("id", ignore_index=True)
+        index["maps"][dataset] = {
+            "points": write_sorted_arrow(f"map-{dataset}-points", df, "id"),
         }
-        # Add "post", "comment" here if they are built in the future.
-        for dataset in ["toppost"]
-    },
-    "posts": load_posts(),
-    "url_metas": load_url_metas(),
-}
-print("Packing")
-with open("/hndr-data/edge.msgpack", "wb") as f:
-    msgpack.dump(out, f)
+        del df
+        # The map data is already mostly packed binary tiles and terrain, so keep it as is.
+        with open(f"{OUT_DIR}/map-{dataset}.msgpack", "wb") as f:
+            msgpack.dump(load_map_data(dataset), f)
+        index["maps"][dataset]["data"] = f"map-{dataset}.msgpack"
+
+    df = load_posts_table().sort_values("id", ignore_index=True)
+    print("Writing posts:", len(df))
+    # `df` is sorted by ID, so each partition is a contiguous range of rows.
+    part_nos, starts = np.unique(
+        (df["id"] // PARTITION_IDS).to_numpy(), return_index=True
+    )
+    ends = np.append(starts[1:], len(df))
+    for part_no, start, end in zip(part_nos.tolist(), starts, ends):
+        index["posts"][part_no] = write_sorted_arrow(
+            f"posts-{part_no}", df.iloc[start:end], "id"
+        )
+    del df
+
+    df = load_url_metas_table().sort_values("url", ignore_index=True)
+    print("Writing URL metas:", len(df))
+    index["url_metas"] = write_sorted_arrow("url_metas", df, "url")
+    del df
+
+    with open(f"{OUT_DIR}/index.json", "w") as f:
+        json.dump(index, f)
+
+
+if FORMAT == "msgpack":
+    build_msgpack()
+elif FORMAT == "arrow":
+    build_arrow()
+else:
+    raise ValueError(f"Unknown format: {FORMAT}")
 print("All done!")
@@ -1,17 +1,25 @@
 from common.data import DatasetEmbModel
 from common.data import load_table
-from common.data import load_umap
+from common.data import merge_on_unique
+from common.emb_data import load_umap
 from common.terrain import render_terrain
+from common.umap_transform import UmapKnnTransformer
 from typing import Dict
 from typing import List
 import joblib
 import math
 import msgpack
 import numpy as np
+import os
 import pandas as pd
+import pyarrow.compute as pc
 import struct
 
 DATASET = "toppost"
+# Maximum deviation (in terrain grid cells) when simplifying terrain paths. Zero disables simplification.
+TERRAIN_SIMPLIFY = float(os.getenv("TERRAIN_SIMPLIFY", "0"))
+# If nonzero, render terrain in tiles using at most approximately this much memory each, instead of the entire grid at once.
+TERRAIN_TILE_MIB = int(os.getenv("TERRAIN_TILE_MIB", "0"))
 
 # Each LOD level doubles the amount of information on screen.
 # At LOD level 1, we want points to be at least N units apart.
@@ -106,12 +114,16 @@ def generate_cities(labels: List[str]):
 def load_data():
     df = load_umap(DATASET)
     if DATASET.endswith("post"):
-        df_items = load_table("posts", columns=["id", "score"])
+        table = "posts"
     elif DATASET.endswith("comment"):
-        df_items = load_table("comments", columns=["id", "score"])
+        table = "comments"
     else:
         raise ValueError("Unknown dataset")
-    return df.merge(df_items, how="inner", on="id")
+    # The map only has a subset of items (e.g. toppost), so don't convert the rest into pandas.
+    df_items = load_table(
+        table, columns=["id", "score"], where=pc.field("id").isin(df["id"].to_numpy())
+    )
+    return merge_on_unique(df, df_items, "id")
 
 
 def calc_lod_levels(count: int) -> int:
@@ -149,6 +161,8 @@ terrain = render_terrain(
     ys=df["y"].to_numpy(),
     dpi=32,
     upscale=32,
+    simplify=TERRAIN_SIMPLIFY,
+    max_tile_bytes=TERRAIN_TILE_MIB * 1024 * 1024 or None,
 )
 terrain_raw = b""
 for level, paths in terrain.items():
@@ -159,9 +173,14 @@ for level, paths in terrain.items():
 res["terrain"] = terrain_raw
 print("Terrain points (KiB):", len(terrain_raw) / 1024)
 
-print("Loading UMAP model")
-with open(f"/hndr-data/umap-{DATASET}-model.joblib", "rb") as f:
-    umapper = joblib.load(f)
+print("Loading UMAP transformer")
+if os.path.exists(f"/hndr-data/umap-{DATASET}-knn.json"):
+    # We only need to place a few city labels, so don't unpickle the entire UMAP model.
+    umapper = UmapKnnTransformer.load(DATASET)
+else:
+    # UMAP outputs from before the kNN transformer only have the full model.
+    with open(f"/hndr-data/umap-{DATASET}-model.joblib", "rb") as f:
+        umapper = joblib.load(f)
 print("Loading embedding model")
 model = DatasetEmbModel(DATASET)
 res["cities"] = [
@@ -1,27 +1,106 @@
+from common.emb_data import load_embs
 from dataclasses import dataclass
+from dataclasses import field
 from FlagEmbedding import BGEM3FlagModel
-from pynndescent import NNDescent
 from sentence_transformers import SentenceTransformer
+from typing import Dict
 from typing import List
 from typing import Optional
 from typing import Tuple
 import json
 import numpy as np
 import numpy.typing as npt
-import os
 import pandas as pd
-import pickle
 import pyarrow
+import pyarrow.compute as pc
 import pyarrow.dataset as ds
 import pyarrow.feather
+import pyarrow.ipc
 
 
-def load_table(basename: str, columns: Optional[List[str]] = None) -> pd.DataFrame:
-    return (
-        ds.dataset(f"/hndr-data/{basename}.arrow", format="ipc")
-        .to_table(columns=columns)
-        .to_pandas()
-    )
+def load_arrow_table(
+    basename: str,
+    columns: Optional[List[str]] = None,
+    # Only keep rows matching this predicate, e.g. `pc.field("score") > 0`.
+    where: Optional[pc.Expression] = None,
+) -> pyarrow.Table:
+    """
+    The file is memory mapped, so (unless it's compressed) the returned table's buffers point directly into the page cache instead of being copied into memory, and only the pages of the requested columns (and the columns `where` uses) are ever read from disk.
+    """
+    reader = pyarrow.ipc.open_file(pyarrow.memory_map(f"/hndr-data/{basename}.arrow"))
+    # This only reads the batches' metadata, as their buffers are memory mapped.
+    table = reader.read_all()
+    if where is not None:
+        # Filtering the table directly would copy every column of the matching rows. The scanner instead only reads the columns `where` uses and only copies `columns`.
+        return ds.dataset(table).to_table(columns=columns, filter=where)
+    if columns is not None:
+        table = table.select(columns)
+    return table
+
+
+def load_table(
+    basename: str,
+    columns: Optional[List[str]] = None,
+    where: Optional[pc.Expression] = None,
+) -> pd.DataFrame:
+    # split_blocks avoids consolidating columns of the same dtype into one 2D block, which would otherwise require a copy of all of them at once.
+    return load_arrow_table(basename, columns, where).to_pandas(split_blocks=True)
+
+
+def load_numpy_columns(
+    basename: str,
+    columns: List[str],
+    where: Optional[pc.Expression] = None,
+) -> Dict[str, np.ndarray]:
+    """
+    Loads fixed-width columns as NumPy arrays. If a column has no nulls and is a single contiguous chunk (i.e. the file has one record batch and there's no `where`), the array is a zero-copy read-only view of the memory mapped file.
+    """
+    table = load_arrow_table(basename, columns, where)
+    out = {}
+    for c in columns:
+        col = table.column(c)
+        if col.num_chunks == 1 and col.null_count == 0:
+            out[c] = col.chunk(0).to_numpy(zero_copy_only=False)
+        else:
+            out[c] = col.to_numpy()
+    return out
+
+
+_table_cache: Dict[Tuple[str, Optional[Tuple[str, ...]]], pyarrow.Table] = {}
+
+
+def load_arrow_table_cached(
+    basename: str, columns: Optional[List[str]] = None
+) -> pyarrow.Table:
+    """
+    Like load_table, but returns the Arrow table and keeps it in memory, so that loading the same table again (e.g. from a different function in the same build script) does not re-read it from disk.
+    If a previously loaded entry has all the requested columns, the columns are selected from it (zero-copy) instead.
+    """
+    key = (basename, None if columns is None else tuple(columns))
+    if key in _table_cache:
+        return _table_cache[key]
+    for (cached_basename, cached_columns), table in _table_cache.items():
+        if cached_basename != basename:
+            continue
+        if cached_columns is None or (
+            columns is not None and set(columns) <= set(cached_columns)
+        ):
+            return table if columns is None else table.select(columns)
+    # Only the requested columns are read from disk.
+    table = load_arrow_table(basename, columns)
+    _table_cache[key] = table
+    return table
+
+
+def load_table_cached(
+    basename: str, columns: Optional[List[str]] = None
+) -> pd.DataFrame:
+    # The DataFrame is always a new conversion, so callers can still freely mutate it.
+    return load_arrow_table_cached(basename, columns).to_pandas()
+
+
+def clear_table_cache():
+    _table_cache.clear()
 
 
 def dump_mmap_matrix(out_basename: str, mat: np.ndarray):
@@ -35,6 +114,58 @@ def dump_mmap_matrix(out_basename: str, mat: np.ndarray):
     fp.flush()
 
 
+# Maximum bytes of matrix rows to gather into memory at once.
+GATHER_BUFSIZE = 1024 * 1024 * 1024
+
+
+def _gather_rows_chunked(mat: np.ndarray, rows: npt.NDArray[np.int64]):
+    """
+    Yields (start, chunk) where `chunk` is `mat[rows[start:start + len(chunk)]]`, reading at most GATHER_BUFSIZE bytes at a time.
+    Within each chunk, rows are read in ascending order, so reads from a memory-mapped `mat` are as sequential as possible.
+    """
+    row_bytes = mat.dtype.itemsize * int(np.prod(mat.shape[1:]))
+    chunk_rows = max(1, GATHER_BUFSIZE // row_bytes)
+    for start in range(0, rows.shape[0], chunk_rows):
+        block = rows[start : start + chunk_rows]
+        order = np.argsort(block, kind="stable")
+        chunk = np.empty((block.shape[0], *mat.shape[1:]), dtype=mat.dtype)
+        chunk[order] = mat[block[order]]
+        yield start, chunk
+
+
+def dump_mmap_matrix_rows(
+    out_basename: str, mat: np.ndarray, rows: npt.NDArray[np.int64]
+):
+    """
+    Equivalent to `dump_mmap_matrix(out_basename, mat[rows])`, but streams the rows directly into the output file instead of first materialising the entire gathered matrix in memory.
+    """
+    fp = np.memmap(
+        f"/hndr-data/{out_basename}.mat",
+        dtype=mat.dtype,
+        mode="w+",
+        shape=(rows.shape[0], *mat.shape[1:]),
+    )
+    for start, chunk in _gather_rows_chunked(mat, rows):
+        fp[start : start + chunk.shape[0]] = chunk
+    fp.flush()
+
+
+def append_mmap_matrix_rows(
+    basename: str, mat: np.ndarray, rows: npt.NDArray[np.int64], start: int
+):
+    """
+    Writes `mat[rows]` after the first `start` rows of the existing matrix, discarding anything already after them (e.g. rows appended by an earlier run that failed before writing its table).
+    """
+    row_bytes = mat.dtype.itemsize * int(np.prod(mat.shape[1:]))
+    # Matrices are stored row-major without any header, so appending rows is just appending bytes.
+    with open(f"/hndr-data/{basename}.mat", "r+b") as f:
+        f.seek(start * row_bytes)
+        f.truncate()
+        for _, chunk in _gather_rows_chunked(mat, rows):
+            f.write(chunk.tobytes())
+        assert f.tell() == (start + rows.shape[0]) * row_bytes
+
+
 def load_mmap_matrix(basename: str, shape: Tuple[int, ...], dtype: npt.DTypeLike):
     return np.memmap(
         f"/hndr-data/{basename}.mat",
@@ -44,24 +175,6 @@ def load_mmap_matrix(basename: str, shape: Tuple[int, ...], dtype: npt.DTypeLike
     )
 
 
-def load_ids(name: str):
-    pfx = f"/hndr-data/{name}"
-    # To use memory map, get file size first, then divide by 4 (size of uint32) to get count.
-    with open(f"{pfx}-ids.mat", "rb") as f:
-        return np.frombuffer(f.read(), dtype=np.uint32)
-
-
-def load_embs(name: str):
-    pfx = f"{name}-embs"
-    mat_ids = load_ids(pfx)
-    count = mat_ids.shape[0]
-    embs_raw_sz = os.path.getsize(f"/hndr-data/{pfx}-data.mat")
-    mat_embs = load_mmap_matrix(
-        f"{pfx}-data", (count, embs_raw_sz // 4 // count), np.float32
-    )
-    return mat_ids, mat_embs
-
-
 def load_embs_as_table(name: str):
     mat_ids, mat_embs = load_embs(name)
     return (
@@ -71,30 +184,42 @@ def load_embs_as_table(name: str):
                 # We can't pass the (N, dim) matrix to DataFrame directly, it'll raise:
                 # > ValueError: Per-column arrays must each be 1-dimensional
                 # Splitting by row takes extremely long. Instead, we'll just store the corresponding row number. This way, any operations on this table will still be able to reference the corresponding row in the embedding matrix.
-                "emb_row": list(range(mat_ids.shape[0])),
+                # Don't use a Python list, it allocates a Python int object per row.
+                "emb_row": np.arange(mat_ids.shape[0], dtype=np.uint32),
             }
         ),
         mat_embs,
     )
 
 
-def load_ann(name: str):
-    with open(f"/hndr-data/ann-{name}.pickle", "rb") as f:
-        ann = pickle.load(f)
-    assert type(ann) == NNDescent
-    return ann
+def join_sorted_ids(
+    left_ids: npt.NDArray, right_ids: npt.NDArray
+) -> Tuple[npt.NDArray[np.int64], npt.NDArray[np.int64]]:
+    """
+    Inner joins two ID arrays, returning (left_rows, right_rows) such that `left_ids[left_rows] == right_ids[right_rows]`.
+    `right_ids` must be unique, but `left_ids` may have duplicates. The result is in the order of `left_ids`, like an inner pandas merge.
+    This uses a sort and binary search, which is much faster and uses much less memory than a pandas hash join over millions of rows.
+    """
+    right_order = np.argsort(right_ids, kind="stable")
+    right_sorted = right_ids[right_order]
+    if right_sorted.shape[0] == 0:
+        empty = np.empty(0, dtype=np.int64)
+        return empty, empty
+    pos = np.searchsorted(right_sorted, left_ids).clip(max=right_sorted.shape[0] - 1)
+    found = right_sorted[pos] == left_ids
+    return np.flatnonzero(found), right_order[pos[found]]
 
 
-def load_umap(name: str):
-    ids = load_ids(f"ann-{name}")
-    mat = load_mmap_matrix(f"umap-{name}-emb", (ids.shape[0], 2), np.float32)
-    return pd.DataFrame(
-        {
-            "id": ids,
-            "x": mat[:, 0],
-            "y": mat[:, 1],
-        }
-    )
+def merge_on_unique(left: pd.DataFrame, right: pd.DataFrame, on: str):
+    """
+    Equivalent to `left.merge(right, on=on, how="inner")` where `right[on]` is unique, but using join_sorted_ids.
+    """
+    left_rows, right_rows = join_sorted_ids(left[on].to_numpy(), right[on].to_numpy())
+    out = left.iloc[left_rows].reset_index(drop=True)
+    for c in right.columns:
+        if c != on:
+            out[c] = right[c].to_numpy()[right_rows]
+    return out
 
 
 _emb_model_cache = {}
@@ -131,6 +256,22 @@ class DatasetEmbModel:
         assert False
 
 
+def dump_api_dicts(name: str, dicts: Dict[str, npt.NDArray[np.object_]]):
+    for col, values in dicts.items():
+        pd.DataFrame({"value": values}).to_feather(
+            f"/hndr-data/api-{name}-dict-{col}.feather"
+        )
+
+
+def load_api_dicts(name: str, cols: List[str]) -> Dict[str, npt.NDArray[np.object_]]:
+    return {
+        col: pd.read_feather(f"/hndr-data/api-{name}-dict-{col}.feather")[
+            "value"
+        ].to_numpy(dtype=object)
+        for col in cols
+    }
+
+
 @dataclass
 class ApiDataset:
     name: str
@@ -142,12 +283,31 @@ class ApiDataset:
     x_max: Optional[float] = None
     y_min: Optional[float] = None
     y_max: Optional[float] = None
+    # Map from dictionary-encoded column to its dictionary. The column in `table` contains integer codes, where code `i` represents the value `dicts[col][i]`.
+    dicts: Dict[str, npt.NDArray[np.object_]] = field(default_factory=dict)
+    # These only exist for datasets built with k-means clusters. Rows are grouped by cluster, where cluster `c` is rows [ivf_offsets[c], ivf_offsets[c + 1]) and has the unit-normalized centroid `ivf_centroids[c]`.
+    ivf_centroids: Optional[npt.NDArray[np.float32]] = None
+    ivf_offsets: Optional[List[int]] = None
+    # These only exist for datasets built with reduced embeddings. `reduced_mat` is `emb_mat @ reduced_proj`, where `reduced_proj` has shape (emb_dim, reduced_dim).
+    reduced_mat: Optional[npt.NDArray[np.float32]] = None
+    reduced_proj: Optional[npt.NDArray[np.float32]] = None
 
     def dump(self):
-        pfx = f"/hndr-data/api-{self.name}"
-        self.table.to_feather(f"{pfx}-table.feather")
+        self.dump_table()
         dump_mmap_matrix(f"api-{self.name}-emb", self.emb_mat)
-        with open(f"{pfx}-meta.json", "w") as f:
+        if self.reduced_mat is not None and self.reduced_proj is not None:
+            dump_mmap_matrix(f"api-{self.name}-emb-reduced", self.reduced_mat)
+            dump_mmap_matrix(f"api-{self.name}-emb-proj", self.reduced_proj)
+        self.dump_meta()
+
+    def dump_table(self):
+        self.table.to_feather(f"/hndr-data/api-{self.name}-table.feather")
+        dump_api_dicts(self.name, self.dicts)
+        if self.ivf_centroids is not None:
+            dump_mmap_matrix(f"api-{self.name}-ivf-centroids", self.ivf_centroids)
+
+    def dump_meta(self):
+        with open(f"/hndr-data/api-{self.name}-meta.json", "w") as f:
             json.dump(
                 {
                     "count": len(self.table),
@@ -156,6 +316,13 @@ class ApiDataset:
                     "x_max": self.x_max,
                     "y_min": self.y_min,
                     "y_max": self.y_max,
+                    "dict_cols": list(self.dicts.keys()),
+                    "ivf_offsets": self.ivf_offsets,
+                    "reduced_dim": (
+                        None
+                        if self.reduced_proj is None
+                        else self.reduced_proj.shape[1]
+                    ),
                 },
                 f,
             )
@@ -167,12 +334,34 @@ class ApiDataset:
             meta = json.load(f)
         count = meta.pop("count")
         emb_dim = meta.pop("emb_dim")
+        dicts = load_api_dicts(name, meta.pop("dict_cols", []))
         table = pyarrow.feather.read_feather(f"{pfx}-table.feather", memory_map=True)
         assert type(table) == pd.DataFrame
         emb_mat = load_mmap_matrix(f"api-{name}-emb", (count, emb_dim), np.float32)
+        ivf_offsets = meta.pop("ivf_offsets", None)
+        ivf_centroids = None
+        if ivf_offsets is not None:
+            ivf_centroids = load_mmap_matrix(
+                f"api-{name}-ivf-centroids", (len(ivf_offsets) - 1, emb_dim), np.float32
+            )
+        reduced_dim = meta.pop("reduced_dim", None)
+        reduced_mat = None
+        reduced_proj = None
+        if reduced_dim is not None:
+            reduced_mat = load_mmap_matrix(
+                f"api-{name}-emb-reduced", (count, reduced_dim), np.float32
+            )
+            reduced_proj = load_mmap_matrix(
+                f"api-{name}-emb-proj", (emb_dim, reduced_dim), np.float32
+            )
         return ApiDataset(
             name=name,
             table=table,
             emb_mat=emb_mat,
+            dicts=dicts,
+            ivf_centroids=ivf_centroids,
+            ivf_offsets=ivf_offsets,
+            reduced_mat=reduced_mat,
+            reduced_proj=reduced_proj,
             **meta,
         )
@@ -1,7 +1,10 @@
+from common.data import load_api_dicts
 from common.data import load_mmap_matrix
 from dataclasses import dataclass
+from dataclasses import field
 from FlagEmbedding import BGEM3FlagModel
 from sentence_transformers import SentenceTransformer
+from typing import Dict
 from typing import List
 from typing import Optional
 from typing import Tuple
@@ -102,6 +105,14 @@ class ApiDatasetOnGpu:
     x_max: Optional[float] = None
     y_min: Optional[float] = None
     y_max: Optional[float] = None
+    # Dictionaries are kept on the host, as they're only used to resolve a few output values.
+    dicts: Dict[str, npt.NDArray[np.object_]] = field(default_factory=dict)
+    # See ApiDataset. The offsets are kept on the host, as they're used to slice `emb_mat` and `table`.
+    ivf_centroids: Optional[cpt.NDArray[cp.float16]] = None
+    ivf_offsets: Optional[List[int]] = None
+    # See ApiDataset.
+    reduced_mat: Optional[cpt.NDArray[cp.float16]] = None
+    reduced_proj: Optional[cpt.NDArray[cp.float16]] = None
 
     @staticmethod
     def load(name: str):
@@ -110,14 +121,42 @@ class ApiDatasetOnGpu:
             meta = json.load(f)
         count = meta.pop("count")
         emb_dim = meta.pop("emb_dim")
+        dicts = load_api_dicts(name, meta.pop("dict_cols", []))
         table = cudf.read_feather(f"{pfx}-table.feather")
         assert type(table) == cudf.DataFrame
         emb_mat = load_mmap_matrix_to_gpu(
             f"api-{name}-emb", (count, emb_dim), np.float32, cp.float16
         )
+        ivf_offsets = meta.pop("ivf_offsets", None)
+        ivf_centroids = None
+        if ivf_offsets is not None:
+            ivf_centroids = load_mmap_matrix_to_gpu(
+                f"api-{name}-ivf-centroids",
+                (len(ivf_offsets) - 1, emb_dim),
+                np.float32,
+                cp.float16,
+            )
+        reduced_dim = meta.pop("reduced_dim", None)
+        reduced_mat = None
+        reduced_proj = None
+        if reduced_dim is not None:
+            reduced_mat = load_mmap_matrix_to_gpu(
+                f"api-{name}-emb-reduced",
+                (count, reduced_dim),
+                np.float32,
+                cp.float16,
+            )
+            reduced_proj = load_mmap_matrix_to_gpu(
+                f"api-{name}-emb-proj", (emb_dim, reduced_dim), np.float32, cp.float16
+            )
         return ApiDatasetOnGpu(
             name=name,
             table=table,
             emb_mat=emb_mat,
+            dicts=dicts,
+            ivf_centroids=ivf_centroids,
+            ivf_offsets=ivf_offsets,
+            reduced_mat=reduced_mat,
+            reduced_proj=reduced_proj,
             **meta,
         )
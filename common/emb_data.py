@@ -0,0 +1,118 @@
+"""
+Access to the embedding matrices (written by build-data's MatrixFile) and the data derived from them (ANN indices, UMAP coordinates).
+
+Every matrix is memory mapped, and each file is only opened and mapped once per process (see `_cached`), so stages and threads within the same process share the same pages instead of each holding their own copy.
+"""
+
+from dataclasses import dataclass
+from pynndescent import NNDescent
+from typing import Any
+from typing import Callable
+from typing import Dict
+from typing import Tuple
+import json
+import numpy as np
+import numpy.typing as npt
+import os
+import pandas as pd
+import pickle
+
+
+@dataclass
+class MatrixMeta:
+    count: int
+    dim: int
+    dtype: str
+
+    @staticmethod
+    def load(name: str) -> "MatrixMeta":
+        pfx = f"/hndr-data/{name}"
+        try:
+            with open(f"{pfx}-meta.json") as f:
+                meta = MatrixMeta(**json.load(f))
+        except FileNotFoundError:
+            # Older exports don't have a metadata file, and are always float32.
+            count = os.path.getsize(f"{pfx}-ids.mat") // 4
+            meta = MatrixMeta(
+                count=count,
+                dim=os.path.getsize(f"{pfx}-data.mat") // 4 // max(1, count),
+                dtype="float32",
+            )
+        # Catch truncated or mismatched files early, instead of silently mapping garbage.
+        data_sz = os.path.getsize(f"{pfx}-data.mat")
+        expected_sz = meta.count * meta.dim * np.dtype(meta.dtype).itemsize
+        if data_sz != expected_sz:
+            raise ValueError(
+                f"{name} data is {data_sz} bytes, expected {expected_sz} for {meta}"
+            )
+        return meta
+
+
+_handle_cache: Dict[str, Tuple[Tuple[int, int, int], Any]] = {}
+
+
+def _cached(path: str, load: Callable[[], Any]):
+    # Keyed by the file's identity as well as its path, so that if a file is rewritten (e.g. by an earlier stage in the same process), it's reloaded instead of returning the stale mapping.
+    st = os.stat(path)
+    version = (st.st_ino, st.st_size, st.st_mtime_ns)
+    cached = _handle_cache.get(path)
+    if cached is None or cached[0] != version:
+        cached = (version, load())
+        _handle_cache[path] = cached
+    return cached[1]
+
+
+def load_ids(name: str) -> npt.NDArray[np.uint32]:
+    path = f"/hndr-data/{name}-ids.mat"
+    # The count is inferred from the file size.
+    return _cached(path, lambda: np.memmap(path, dtype=np.uint32, mode="r"))
+
+
+def load_embs(name: str):
+    pfx = f"{name}-embs"
+    mat_ids = load_ids(pfx)
+    path = f"/hndr-data/{pfx}-data.mat"
+
+    def load():
+        meta = MatrixMeta.load(pfx)
+        assert meta.count == mat_ids.shape[0]
+        return np.memmap(path, dtype=meta.dtype, mode="r", shape=(meta.count, meta.dim))
+
+    return mat_ids, _cached(path, load)
+
+
+def load_ann(name: str) -> NNDescent:
+    path = f"/hndr-data/ann-{name}.pickle"
+
+    def load():
+        with open(path, "rb") as f:
+            ann = pickle.load(f)
+        assert type(ann) == NNDescent
+        return ann
+
+    return _cached(path, load)
+
+
+def load_umap(name: str):
+    ids_name = f"umap-{name}"
+    if not os.path.exists(f"/hndr-data/{ids_name}-ids.mat"):
+        # Older UMAP outputs don't have their own IDs file, and are always in the order of the ANN index.
+        ids_name = f"ann-{name}"
+    ids = load_ids(ids_name)
+    path = f"/hndr-data/umap-{name}-emb.mat"
+    mat = _cached(
+        path,
+        lambda: np.memmap(path, dtype=np.float32, mode="r", shape=(ids.shape[0], 2)),
+    )
+    return pd.DataFrame(
+        {
+            "id": ids,
+            "x": mat[:, 0],
+            "y": mat[:, 1],
+        }
+    )
+
+
+def load_bgem3_umap():
+    # The "toppost" dataset is the BGE-M3 embeddings of top posts.
+    return load_umap("toppost")
@@ -0,0 +1,130 @@
+"""
+Spherical k-means for unit-normalized embeddings.
+
+Since the embeddings are unit vectors, the nearest centroid by cosine distance is the one with the largest dot product, so assignment is a GEMM followed by an argmax. Centroids are the normalized mean of their rows. This is much faster than a general Euclidean k-means, and works over a memory-mapped matrix in chunks, so it scales to datasets that don't fit in memory.
+"""
+
+from dataclasses import dataclass
+from typing import Optional
+import numpy as np
+import numpy.typing as npt
+
+# Maximum bytes for each chunk's (rows, k) similarity matrix.
+SIMS_BUFSIZE = 256 * 1024 * 1024
+
+
+@dataclass
+class SphericalKMeansResult:
+    # Shape (k, dim), unit-normalized, float32.
+    cluster_centers: npt.NDArray[np.float32]
+    # Shape (n,), the cluster of each row.
+    labels: npt.NDArray[np.int32]
+    # Sum of squared Euclidean distances from each normalized row to its centroid, comparable to scikit-learn's inertia (for each row, this is `2 - 2 * cos_sim`).
+    inertia: float
+    n_iter: int
+
+
+def _chunks(mat: np.ndarray, chunk_rows: int):
+    for start in range(0, mat.shape[0], chunk_rows):
+        # Always compute in float32, even if the input is float16 or int8 to save memory and disk reads. Rows are normalized, as quantized rows aren't exactly unit vectors (and int8 rows are missing their dequantization scale), which would otherwise skew centroids and inertia.
+        yield start, _normalize(
+            np.asarray(mat[start : start + chunk_rows], dtype=np.float32)
+        )
+
+
+def _normalize(mat: np.ndarray):
+    norms = np.linalg.norm(mat, axis=1, keepdims=True)
+    return mat / np.maximum(norms, 1e-12)
+
+
+def _sample_rows(mat: np.ndarray, count: int, rng: np.random.Generator):
+    rows = np.sort(rng.choice(mat.shape[0], min(mat.shape[0], count), replace=False))
+    return _normalize(np.asarray(mat[rows], dtype=np.float32))
+
+
+def init_kmeans_pp(
+    mat: np.ndarray,
+    k: int,
+    rng: np.random.Generator,
+    # k-means++ is O(k * sample), so only run it on a sample of rows.
+    sample_size: int = 100_000,
+):
+    sample = _sample_rows(mat, max(k, sample_size), rng)
+    centers = np.empty((k, sample.shape[1]), dtype=np.float32)
+    centers[0] = sample[rng.integers(sample.shape[0])]
+    # Cosine distance of each sampled row to its nearest chosen centroid.
+    dists = (1 - sample @ centers[0]).clip(min=0)
+    for i in range(1, k):
+        total = dists.sum()
+        if total > 0:
+            row = rng.choice(sample.shape[0], p=dists / total)
+        else:
+            row = rng.integers(sample.shape[0])
+        centers[i] = sample[row]
+        dists = np.minimum(dists, (1 - sample @ centers[i]).clip(min=0))
+    return centers
+
+
+def spherical_kmeans(
+    mat: np.ndarray,
+    k: int,
+    *,
+    # If provided, must have shape (k, dim). Otherwise, k-means++ is used.
+    init: Optional[np.ndarray] = None,
+    max_iter: int = 100,
+    # Stop when fewer than this fraction of rows change cluster in an iteration.
+    tol: float = 1e-4,
+    rng: Optional[np.random.Generator] = None,
+):
+    rng = rng or np.random.default_rng()
+    n, dim = mat.shape
+    if init is None:
+        centers = init_kmeans_pp(mat, k, rng)
+    else:
+        assert init.shape == (k, dim)
+        centers = _normalize(init.astype(np.float32))
+    chunk_rows = max(1, min(65536, SIMS_BUFSIZE // (k * 4)))
+    labels = np.full(n, -1, dtype=np.int32)
+    sim_sum = 0.0
+    sq_sum = 0.0
+
+    n_iter = 0
+    for n_iter in range(1, max_iter + 1):
+        sums = np.zeros((k, dim), dtype=np.float64)
+        counts = np.zeros(k, dtype=np.int64)
+        changed = 0
+        sim_sum = 0.0
+        sq_sum = 0.0
+        for start, chunk in _chunks(mat, chunk_rows):
+            sims = chunk @ centers.T
+            chunk_labels = sims.argmax(axis=1).astype(np.int32)
+            sim_sum += sims[np.arange(chunk.shape[0]), chunk_labels].sum(
+                dtype=np.float64
+            )
+            # This is the row count, except for all-zero rows, which can't be normalized.
+            sq_sum += np.einsum("ij,ij->", chunk, chunk, dtype=np.float64)
+            end = start + chunk.shape[0]
+            changed += np.count_nonzero(labels[start:end] != chunk_labels)
+            labels[start:end] = chunk_labels
+            # Sum rows by cluster. Sorting and using reduceat is much faster than np.add.at.
+            order = np.argsort(chunk_labels, kind="stable")
+            clusters, starts = np.unique(chunk_labels[order], return_index=True)
+            sums[clusters] += np.add.reduceat(chunk[order], starts, axis=0)
+            counts[clusters] += np.diff(np.append(starts, chunk.shape[0]))
+
+        centers = _normalize(sums).astype(np.float32)
+        empty = np.flatnonzero(counts == 0)
+        if empty.shape[0]:
+            # Reseed empty clusters with random rows, so we always return k clusters.
+            centers[empty] = _sample_rows(mat, empty.shape[0], rng)
+        print(f"[k={k}] Iteration {n_iter}: {changed} rows changed cluster")
+        if changed <= tol * n and not empty.shape[0]:
+            break
+
+    return SphericalKMeansResult(
+        cluster_centers=centers,
+        labels=labels,
+        # ||x - c||^2 = ||x||^2 - 2 x.c + ||c||^2, where centroids are unit vectors. The labels and similarities are from the last assignment pass (i.e. before the final centroid update), which is a close upper bound.
+        inertia=float(sq_sum - 2 * sim_sum + n),
+        n_iter=n_iter,
+    )
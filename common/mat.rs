@@ -46,11 +46,13 @@ pub fn load_mat<E: Copy + Default + Elem>(name: &str, rows: usize, cols: usize)
 }
 
 pub struct MatrixFile {
+  name: String,
   temp_file_name: String,
   dest_file_name: String,
   out_id: BufWriter<File>,
   out_data: BufWriter<File>,
   count: usize,
+  row_len: Option<usize>,
 }
 
 impl MatrixFile {
@@ -71,16 +73,19 @@ impl MatrixFile {
         .unwrap(),
     );
     Some(Self {
+      name: name.to_string(),
       temp_file_name,
       dest_file_name,
       out_id,
       out_data,
       count: 0,
+      row_len: None,
     })
   }
 
   pub async fn push(&mut self, id: u32, data_raw: &[u8]) {
     self.count += 1;
+    assert_eq!(*self.row_len.get_or_insert(data_raw.len()), data_raw.len());
     self.out_id.write_u32_le(id).await.unwrap();
     self.out_data.write_all(data_raw).await.unwrap();
   }
@@ -88,6 +93,18 @@ impl MatrixFile {
   pub async fn finish(&mut self) {
     self.out_data.flush().await.unwrap();
     self.out_id.flush().await.unwrap();
+    // Read by common/emb_data.py, so that the shape doesn't need to be inferred from the file sizes. All our matrices are f32 embeddings.
+    let meta = serde_json::json!({
+      "count": self.count,
+      "dim": self.row_len.unwrap_or(0) / 4,
+      "dtype": "float32",
+    });
+    fs::write(
+      format!("/hndr-data/{}-meta.json", self.name),
+      serde_json::to_vec(&meta).unwrap(),
+    )
+    .await
+    .unwrap();
     fs::rename(&self.temp_file_name, &self.dest_file_name)
       .await
       .unwrap();
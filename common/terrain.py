@@ -1,11 +1,61 @@
 from scipy.ndimage import gaussian_filter
 from typing import Dict
 from typing import List
+from typing import Optional
 import cv2
 import numpy as np
 import numpy.typing as npt
 import pandas as pd
 
+# gaussian_filter uses 12 bytes per pixel at peak: the upscaled input, the output, and an intermediate buffer for the separable passes.
+_BLUR_BYTES_PER_PIXEL = 12
+
+
+def _blur_tiles(
+    grid: npt.NDArray[np.float32],
+    *,
+    upscale: int,
+    sigma: int,
+    max_tile_bytes: Optional[int],
+):
+    """
+    Yields (y, x, tile) where `tile` is the upscaled and blurred region of `grid` starting at upscaled pixel (y, x).
+    Each tile is blurred with a halo of surrounding cells wide enough to cover the Gaussian kernel, so the stitched result is the same as blurring the entire upscaled grid at once.
+    """
+    grid_height, grid_width = grid.shape
+    if max_tile_bytes is None:
+        tile_size = max(grid_height, grid_width)
+        halo = 0
+    else:
+        # This is the radius gaussian_filter uses with its default truncate=4.0.
+        radius = int(4.0 * sigma * upscale + 0.5) if sigma else 0
+        # Tiles and halos are in (non-upscaled) grid cells, so that upscaling a tile is just repeating its cells.
+        halo = -(-radius // upscale)
+        tile_axis_px = int((max_tile_bytes / _BLUR_BYTES_PER_PIXEL) ** 0.5)
+        tile_size = tile_axis_px // upscale - 2 * halo
+        if tile_size < 1:
+            raise ValueError(
+                f"Tile memory budget of {max_tile_bytes} bytes is too small for blur halo of {halo} cells"
+            )
+    for y0 in range(0, grid_height, tile_size):
+        y1 = min(grid_height, y0 + tile_size)
+        for x0 in range(0, grid_width, tile_size):
+            x1 = min(grid_width, x0 + tile_size)
+            # Where the halo would go past the grid edge, we clip it, so that gaussian_filter's boundary mode applies at the same place as it would for the entire grid.
+            hy0, hy1 = max(0, y0 - halo), min(grid_height, y1 + halo)
+            hx0, hx1 = max(0, x0 - halo), min(grid_width, x1 + halo)
+            tile = grid[hy0:hy1, hx0:hx1]
+            # Upscale before blurring. If we do it after, the smooth blurred "edges" get "rough" because we are just duplicating the pixels.
+            tile = tile.repeat(upscale, axis=0).repeat(upscale, axis=1)
+            if sigma:
+                tile = gaussian_filter(tile, sigma=sigma * upscale)
+            # Remove the halo.
+            tile = tile[
+                (y0 - hy0) * upscale : (y1 - hy0) * upscale,
+                (x0 - hx0) * upscale : (x1 - hx0) * upscale,
+            ]
+            yield y0 * upscale, x0 * upscale, tile
+
 
 def render_terrain(
     xs: npt.NDArray[np.float32],
@@ -20,6 +70,12 @@ def render_terrain(
     # This is what Google Maps does with terrain; it's not a smooth gradient. Must be at least one.
     contours: int = 4,
     use_log_scale=True,
+    # If nonzero, simplify each path using the Douglas-Peucker algorithm, where this is the maximum distance (in grid cells, before upscaling) between the original and simplified path. This can greatly reduce the amount of points at high upscale values, where edges are made up of many tiny steps.
+    simplify: float = 0,
+    # If set, upscale and blur in tiles that each use at most approximately this many bytes, instead of the entire grid at once. At high dpi and upscale values, the entire float32 grid can be many GiB, and blurring it requires several more copies.
+    # This only bounds the blur. Contours must be continuous across tiles, so tracing them still needs the entire upscaled bucket grid, a mask, and findContours's own copy of the mask, at one byte per pixel each.
+    # The result is the same, but each tile is blurred twice (once to find the value range, and once to bucket), so this is slower.
+    max_tile_bytes: Optional[int] = None,
 ):
     x_min, x_max = (xs.min(), xs.max())
     y_min, y_max = (ys.min(), ys.max())
@@ -38,48 +94,70 @@ def render_terrain(
 
     grid = np.zeros((grid_height, grid_width), dtype=np.float32)
     grid[gv["y"], gv["x"]] = gv["density"]
-    # Upscale before blurring. If we do it after, the smooth blurred "edges" get "rough" because we are just duplicating the pixels.
-    grid = grid.repeat(upscale, axis=0).repeat(upscale, axis=1)
-    if sigma:
-        grid = gaussian_filter(grid, sigma=sigma * upscale)
 
-    g_min, g_max = grid.min(), grid.max()
+    def blur_tiles():
+        return _blur_tiles(
+            grid, upscale=upscale, sigma=sigma, max_tile_bytes=max_tile_bytes
+        )
+
+    g_min, g_max = np.inf, -np.inf
+    for _, _, tile in blur_tiles():
+        g_min = min(g_min, tile.min())
+        g_max = max(g_max, tile.max())
     buckets = contours
     bucket_size = (g_max - g_min) / buckets
-    # Values fall into [0, buckets - 1].
-    # Yes, this means that some points will fall onto a grid cell with value 0 i.e. some will be on water. This looks nicer than trying to force land onto every point (i.e. bucket minimum value of 1), because it creates too many sparse random-looking dull blotches.
-    grid = (grid - g_min) // bucket_size
-    # Some values may lie exactly on the max and will end up with a bucket of `buckets`.
-    grid = np.clip(grid, 0, buckets - 1)
+    # The entire bucketed grid is still needed at once so that contours are continuous across tiles, but it's only one byte per pixel.
+    bucket_grid = np.empty((grid_height * upscale, grid_width * upscale), np.uint8)
+    for y, x, tile in blur_tiles():
+        # Values fall into [0, buckets - 1].
+        # Yes, this means that some points will fall onto a grid cell with value 0 i.e. some will be on water. This looks nicer than trying to force land onto every point (i.e. bucket minimum value of 1), because it creates too many sparse random-looking dull blotches.
+        tile = (tile - g_min) // bucket_size
+        # Some values may lie exactly on the max and will end up with a bucket of `buckets`.
+        tile = np.clip(tile, 0, buckets - 1)
+        bucket_grid[y : y + tile.shape[0], x : x + tile.shape[1]] = tile
+    grid = bucket_grid
 
     # Map from level to list of paths, where a path is a NumPy matrix of (x, y) points.
     shapes: Dict[int, List[npt.NDArray[np.float32]]] = {}
+    # Reuse one mask for every bucket, instead of allocating a bool and a uint8 copy of the entire grid for each.
+    mask = np.empty_like(grid)
     for bucket in range(buckets):
         shapes[bucket] = []
-        num_shapes, labelled_image = cv2.connectedComponents(
-            (grid == bucket).astype(np.uint8)
+        # Previously, we labelled connected components and then ran findContours on a full-size mask for each component, which is O(components * pixels) and dominated build time at high upscale. Instead, do one pass per bucket and use the hierarchy to pick out each component's outer edge.
+        # We use RETR_CCOMP instead of RETR_EXTERNAL, as a component may lie inside a hole of another component of the same bucket (e.g. a ring around a higher bucket, which itself has an island of this bucket). RETR_EXTERNAL would drop those inner components.
+        np.equal(grid, bucket, out=mask.view(bool))
+        shape_contours, hierarchy = cv2.findContours(
+            mask, cv2.RETR_CCOMP, cv2.CHAIN_APPROX_SIMPLE
         )
-        # Ignore label 0 as it's the background.
-        for shape_no in range(1, num_shapes):
-            shape_mask = labelled_image == shape_no
-            # Use RETR_EXTERNAL as we only want the outer edges, and don't care about inner holes since they'll be represented by other larger-bucket shapes.
-            shape_contours, _ = cv2.findContours(
-                shape_mask.astype(np.uint8), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE
-            )
-            for shape_border_points in shape_contours:
-                # The resulting shape is (N, 1, 2), where N is the number of points. Remove unnecessary second dimension.
-                shape_border_points = shape_border_points.squeeze(1)
+        if hierarchy is None:
+            # No shapes at all in this bucket.
+            continue
+        # The hierarchy has shape (1, N, 4), where each row is [next, prev, first_child, parent].
+        for shape_border_points, (_, _, _, parent) in zip(shape_contours, hierarchy[0]):
+            # Contours with a parent are inner holes. We only want the outer edges, and don't care about inner holes since they'll be represented by other larger-bucket shapes.
+            if parent != -1:
+                continue
+            # The resulting shape is (N, 1, 2), where N is the number of points. Remove unnecessary second dimension.
+            shape_border_points = shape_border_points.squeeze(1)
+            if shape_border_points.shape[0] < 4:
+                # Not a polygon.
+                continue
+            # We want bucket 0 only when it cuts out an inner hole in a larger bucket.
+            if bucket == 0 and (0, 0) in shape_border_points:
+                continue
+            if simplify:
+                # Epsilon is in upscaled pixels, but we want it to be in grid cells so that it's independent of the upscale factor.
+                shape_border_points = cv2.approxPolyDP(
+                    shape_border_points, simplify * upscale, True
+                ).squeeze(1)
                 if shape_border_points.shape[0] < 4:
-                    # Not a polygon.
-                    continue
-                # We want bucket 0 only when it cuts out an inner hole in a larger bucket.
-                if bucket == 0 and (0, 0) in shape_border_points:
+                    # Simplified to something that is no longer a useful polygon.
                     continue
 
-                # Convert back to original scale.
-                shape_border_points = shape_border_points / upscale
-                shape_border_points[:, 0] = shape_border_points[:, 0] / dpi + x_min
-                shape_border_points[:, 1] = shape_border_points[:, 1] / dpi + y_min
-                shapes[bucket].append(shape_border_points.astype(np.float32))
+            # Convert back to original scale.
+            shape_border_points = shape_border_points / upscale
+            shape_border_points[:, 0] = shape_border_points[:, 0] / dpi + x_min
+            shape_border_points[:, 1] = shape_border_points[:, 1] / dpi + y_min
+            shapes[bucket].append(shape_border_points.astype(np.float32))
 
     return shapes
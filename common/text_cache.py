@@ -0,0 +1,72 @@
+"""
+An on-disk cache of model outputs keyed by a hash of the input text, so that duplicate texts (reposts, identical titles, "[deleted]" comments, etc.) are only ever inferenced once.
+
+This uses SQLite as it's in the standard library, and is a fast enough key-value store for keys and values that are at most a few KiB.
+"""
+
+from typing import Callable
+from typing import Dict
+from typing import Iterable
+from typing import List
+from typing import Tuple
+import hashlib
+import sqlite3
+
+# SQLite's default limit on the number of parameters in a query is 999 on older versions.
+_QUERY_KEYS = 500
+
+
+def text_key(namespace: str, text: str) -> bytes:
+    h = hashlib.blake2b(digest_size=16)
+    h.update(namespace.encode("utf-8"))
+    h.update(b"\0")
+    h.update(text.encode("utf-8"))
+    return h.digest()
+
+
+class TextCache:
+    def __init__(self, path: str, namespace: str):
+        # Outputs depend on the model and how it's run, not just the text, so this must identify both. Otherwise, changing the model or its precision would keep serving the old outputs.
+        self.namespace = namespace
+        self.db = sqlite3.connect(path)
+        # WAL makes writes much cheaper, and we can afford to lose the last few writes on a crash.
+        self.db.execute("pragma journal_mode = wal")
+        self.db.execute("pragma synchronous = normal")
+        self.db.execute(
+            "create table if not exists kv (k blob primary key, v blob not null) without rowid"
+        )
+
+    def get_many(self, keys: List[bytes]) -> Dict[bytes, bytes]:
+        out = {}
+        for start in range(0, len(keys), _QUERY_KEYS):
+            chunk = keys[start : start + _QUERY_KEYS]
+            out.update(
+                self.db.execute(
+                    f"select k, v from kv where k in ({','.join('?' * len(chunk))})",
+                    chunk,
+                )
+            )
+        return out
+
+    def put_many(self, items: Iterable[Tuple[bytes, bytes]]):
+        with self.db:
+            self.db.executemany("insert or replace into kv (k, v) values (?, ?)", items)
+
+    def map(
+        self, texts: List[str], compute: Callable[[List[str]], List[bytes]]
+    ) -> Tuple[List[bytes], int]:
+        """
+        Returns the value for every text, calling `compute` only for the distinct texts not in the cache, and the number of texts that were computed.
+        """
+        keys = [text_key(self.namespace, t) for t in texts]
+        found = self.get_many(list(set(keys)))
+        # A dict, so that duplicates within `texts` are also only computed once.
+        missing: Dict[bytes, str] = {}
+        for k, t in zip(keys, texts):
+            if k not in found:
+                missing.setdefault(k, t)
+        if missing:
+            computed = dict(zip(missing.keys(), compute(list(missing.values()))))
+            self.put_many(computed.items())
+            found.update(computed)
+        return [found[k] for k in keys], len(missing)
@@ -0,0 +1,70 @@
+"""
+A lightweight replacement for `umap.UMAP.transform`, for when we only need approximate coordinates for a few new points (e.g. map city labels).
+
+Loading the pickled UMAP model requires unpickling its entire training matrix, kNN graph, and search index, which takes a long time and a lot of memory. Instead, we store a sample of the training embeddings and their UMAP coordinates, and place a new point at the weighted average of its nearest neighbors' coordinates. This is also how UMAP initializes transformed points before optimizing them.
+"""
+
+from common.data import dump_mmap_matrix
+from common.data import load_mmap_matrix
+from dataclasses import dataclass
+import json
+import numpy as np
+import numpy.typing as npt
+
+# Maximum bytes for each chunk's (rows, reference count) similarity matrix.
+SIMS_BUFSIZE = 256 * 1024 * 1024
+
+
+@dataclass
+class UmapKnnTransformer:
+    # Shape (n, dim), unit-normalized.
+    embs: npt.NDArray[np.float32]
+    # Shape (n, 2), the UMAP coordinates of each row in `embs`.
+    coords: npt.NDArray[np.float32]
+    n_neighbors: int = 15
+
+    def dump(self, name: str):
+        dump_mmap_matrix(f"umap-{name}-knn-embs", self.embs)
+        dump_mmap_matrix(f"umap-{name}-knn-coords", self.coords)
+        with open(f"/hndr-data/umap-{name}-knn.json", "w") as f:
+            json.dump(
+                {
+                    "count": self.embs.shape[0],
+                    "emb_dim": self.embs.shape[1],
+                    "n_neighbors": self.n_neighbors,
+                },
+                f,
+            )
+
+    @staticmethod
+    def load(name: str):
+        with open(f"/hndr-data/umap-{name}-knn.json") as f:
+            meta = json.load(f)
+        count = meta["count"]
+        return UmapKnnTransformer(
+            embs=load_mmap_matrix(
+                f"umap-{name}-knn-embs", (count, meta["emb_dim"]), np.float32
+            ),
+            coords=load_mmap_matrix(f"umap-{name}-knn-coords", (count, 2), np.float32),
+            n_neighbors=meta["n_neighbors"],
+        )
+
+    def transform(self, embs: np.ndarray) -> npt.NDArray[np.float32]:
+        embs = np.asarray(embs, dtype=np.float32)
+        embs = embs / np.maximum(np.linalg.norm(embs, axis=1, keepdims=True), 1e-12)
+        k = min(self.n_neighbors, self.embs.shape[0])
+        out = np.empty((embs.shape[0], 2), dtype=np.float32)
+        chunk_rows = max(1, SIMS_BUFSIZE // (self.embs.shape[0] * 4))
+        for start in range(0, embs.shape[0], chunk_rows):
+            sims = embs[start : start + chunk_rows] @ self.embs.T
+            nn = np.argpartition(-sims, k - 1, axis=1)[:, :k]
+            dists = 1 - np.take_along_axis(sims, nn, axis=1)
+            # Like UMAP's membership strengths: the nearest neighbor has weight 1, and weights decay with distance relative to the typical neighbor distance of this point.
+            rho = dists.min(axis=1, keepdims=True)
+            sigma = np.maximum((dists - rho).mean(axis=1, keepdims=True), 1e-6)
+            weights = np.exp(-(dists - rho) / sigma)
+            weights /= weights.sum(axis=1, keepdims=True)
+            out[start : start + sims.shape[0]] = (
+                weights[:, :, None] * self.coords[nn]
+            ).sum(axis=1)
+        return out
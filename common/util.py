@@ -1,3 +1,4 @@
+from typing import List
 from typing import Optional
 from typing import TypeVar
 import os
@@ -16,3 +17,22 @@ T = TypeVar("T")
 def assert_exists(val: Optional[T]) -> T:
     assert val is not None
     return val
+
+
+def plan_batches(lens: List[int], max_tokens: int) -> List[List[int]]:
+    """
+    Splits texts with token counts `lens` into batches of their indices, where each batch has at most `max_tokens` tokens including padding (unless a single text is longer).
+    """
+    # Longest first, so that if a batch is going to run out of memory, it happens on the first batch.
+    order = sorted(range(len(lens)), key=lambda i: -lens[i])
+    batches = []
+    batch = []
+    for i in order:
+        # Since texts are in descending length order, the first text in the batch is the longest, and every text in the batch will be padded to its length.
+        if batch and lens[batch[0]] * (len(batch) + 1) > max_tokens:
+            batches.append(batch)
+            batch = []
+        batch.append(i)
+    if batch:
+        batches.append(batch)
+    return batches
@@ -1,14 +1,23 @@
+from common.text_cache import TextCache
+from common.util import plan_batches
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
 from FlagEmbedding import BGEM3FlagModel
 from msgpipe import PyIpc
+from queue import Queue
 from sentence_transformers import SentenceTransformer
 from service_toolkit.panic import set_excepthook
 from statsd import StatsClient
 from typing import Dict
 from typing import List
+from typing import Optional
+from typing import Tuple
+import multiprocessing as mp
 import numpy as np
 import os
+import struct
 import time
+import torch
 
 set_excepthook()
 
@@ -16,57 +25,357 @@ MODE = os.getenv("HNDR_EMBEDDER_MODE")
 
 statsd = StatsClient("localhost", 8125, prefix="embedder")
 
-if MODE == "bgem3":
-    # We intentionally use this model for a separate more-powerful more-accurate embeddings dataset, so don't use float16 even if loss is marginal.
-    model = BGEM3FlagModel(
-        "BAAI/bge-m3", use_fp16=False, normalize_embeddings=True, device="cuda"
-    )
-elif MODE == "jinav2small":
-    model = SentenceTransformer(
-        "jinaai/jina-embeddings-v2-small-en",
-        trust_remote_code=True,
-        device="cuda",
-    )
-else:
-    raise ValueError(f"Unknown mode: {MODE}")
+# Maximum tokens (including padding) in one forward pass. Texts are sorted by length before batching, so batches of short texts contain many texts, and a long text doesn't cause every other text in its batch to be padded to its length.
+BATCH_TOKENS = int(os.getenv("HNDR_EMBEDDER_BATCH_TOKENS", "32768"))
+
+# "cuda" or "cpu". On CPU, requests are split across a pool of worker processes, each with its own copy of the model.
+DEVICE = os.getenv("HNDR_EMBEDDER_DEVICE", "cuda")
+CPU_WORKERS = int(
+    os.getenv("HNDR_EMBEDDER_CPU_WORKERS", str(max(1, mp.cpu_count() // 4)))
+)
+# Quantize linear layers to int8 when running on CPU. This is usually 2-4x faster, with a small loss in accuracy.
+CPU_QUANTIZE = os.getenv("HNDR_EMBEDDER_CPU_QUANTIZE", "1") == "1"
+
+# If enabled, batches are padded and copied to the GPU (via pinned memory) on background threads, up to PIPELINE_PREFETCH batches ahead, and the model is called directly instead of through encode(). This way, the GPU doesn't sit idle while the CPU prepares each batch.
+PIPELINE = os.getenv("HNDR_EMBEDDER_PIPELINE", "0") == "1"
+PIPELINE_THREADS = int(os.getenv("HNDR_EMBEDDER_PIPELINE_THREADS", "4"))
+PIPELINE_PREFETCH = int(os.getenv("HNDR_EMBEDDER_PIPELINE_PREFETCH", "4"))
+# When pipelining, texts are tokenized this many at a time as batches are needed, so the first batch doesn't wait for the entire request to be tokenized.
+PIPELINE_TOKENIZE_CHUNK = int(os.getenv("HNDR_EMBEDDER_PIPELINE_TOKENIZE_CHUNK", "256"))
+# If set, outputs are cached in a SQLite database at this path, keyed by a hash of the text, and duplicate texts are never embedded again.
+CACHE_PATH = os.getenv("HNDR_EMBEDDER_CACHE_PATH", "")
+if PIPELINE and DEVICE != "cuda":
+    raise ValueError("Pipelining requires CUDA")
+if PIPELINE and PIPELINE_THREADS < 2:
+    # One thread plans and tokenizes batches, and the others pad and copy them.
+    raise ValueError("Pipelining requires at least 2 threads")
+
+model = None
+max_length = 0
+
+
+def init_model():
+    global max_length, model
+    if MODE == "bgem3":
+        # We intentionally use this model for a separate more-powerful more-accurate embeddings dataset, so don't use float16 even if loss is marginal.
+        model = BGEM3FlagModel(
+            "BAAI/bge-m3", use_fp16=False, normalize_embeddings=True, devices=DEVICE
+        )
+        module = model.model
+        # This is the default of BGEM3FlagModel.encode.
+        max_length = 8192
+    elif MODE == "jinav2small":
+        model = SentenceTransformer(
+            "jinaai/jina-embeddings-v2-small-en",
+            trust_remote_code=True,
+            device=DEVICE,
+        )
+        module = model
+        max_length = model.max_seq_length
+    else:
+        raise ValueError(f"Unknown mode: {MODE}")
+    if PIPELINE:
+        # The pipelined path calls the module directly, but it's encode() that moves it to the device and puts it in eval mode.
+        module.to(DEVICE)
+        module.eval()
+    if DEVICE == "cpu" and CPU_QUANTIZE:
+        # Dynamic quantization stores the weights as int8 and quantizes activations on the fly, so it doesn't need calibration data.
+        torch.quantization.quantize_dynamic(
+            module, {torch.nn.Linear}, dtype=torch.qint8, inplace=True
+        )
+
+
+def init_cpu_worker():
+    # Otherwise, every worker uses every core, oversubscribing the CPU by a factor of CPU_WORKERS.
+    torch.set_num_threads(max(1, mp.cpu_count() // CPU_WORKERS))
+    init_model()
 
 
 def convert_dict(d: Dict[str, np.ndarray]):
     return {k: v.item() for k, v in d.items()}
 
 
+def pack_lexical_weights(lexical_weights: List[Dict[str, np.ndarray]]):
+    # CSR style: the weights of text `i` are at [offsets[i], offsets[i + 1]) in `ids` and `weights`.
+    offsets = np.zeros(len(lexical_weights) + 1, dtype=np.uint32)
+    np.cumsum([len(d) for d in lexical_weights], out=offsets[1:])
+    count = offsets[-1].item()
+    ids = np.fromiter(
+        (int(k) for d in lexical_weights for k in d.keys()), np.uint32, count
+    )
+    weights = np.fromiter(
+        (v for d in lexical_weights for v in d.values()), np.float32, count
+    ).astype(np.float16)
+    return offsets, ids, weights
+
+
 @dataclass
 class EmbedReq:
     texts: List[str]
+    # If true, lexical weights are returned as packed arrays instead of a list of dicts.
+    compact: bool = False
 
 
-last_embed_time = time.time()
+def tokenize(texts: List[str]) -> List[List[int]]:
+    return model.tokenizer(texts, truncation=True, max_length=max_length)["input_ids"]
 
 
-def embed_handler(x: EmbedReq):
-    global last_embed_time
-    embed_started = time.time()
-    statsd.timing("idle_gpu_ms", (embed_started - last_embed_time) * 1000)
+def encode_batch(texts: List[str]):
     if type(model) == BGEM3FlagModel:
-        out = model.encode(x.texts, batch_size=1, return_dense=True, return_sparse=True)
+        out = model.encode(
+            texts, batch_size=len(texts), return_dense=True, return_sparse=True
+        )
         # dense_vecs is a NumPy matrix of shape (N, 1024); lexical_weights is a Python List[defaultdict[str, np.float32]].
         dense_vecs = out["dense_vecs"]
         lexical_weights = out["lexical_weights"]
         assert type(lexical_weights) == list
-    elif type(model) == SentenceTransformer:
+        return dense_vecs, lexical_weights
+    if type(model) == SentenceTransformer:
         out = model.encode(
-            x.texts, batch_size=1, normalize_embeddings=True, convert_to_numpy=True
+            texts,
+            batch_size=len(texts),
+            normalize_embeddings=True,
+            convert_to_numpy=True,
         )
         assert type(out) == np.ndarray
-        dense_vecs = out
-        lexical_weights = None
+        return out, None
+    assert False
+
+
+def merge_outputs(
+    count: int,
+    parts: List[Tuple[List[int], Tuple[np.ndarray, Optional[list]]]],
+):
+    # Each part is the indices of its texts in the original input, and its (dense_vecs, lexical_weights) output. Returns the outputs in the original order.
+    dense_vecs = None
+    lexical_weights = None
+    for rows, (part_dense, part_lexical) in parts:
+        if dense_vecs is None:
+            dense_vecs = np.empty((count, part_dense.shape[1]), part_dense.dtype)
+        dense_vecs[rows] = part_dense
+        if part_lexical is not None:
+            if lexical_weights is None:
+                lexical_weights = [None] * count
+            for i, w in zip(rows, part_lexical):
+                lexical_weights[i] = w
+    assert dense_vecs is not None
+    return dense_vecs, lexical_weights
+
+
+def prepare_batch(input_ids: List[List[int]]):
+    # Runs on a tokenization thread. Copy from pinned memory on a separate stream, so the copy overlaps with the forward pass of the previous batch.
+    features = model.tokenizer.pad({"input_ids": input_ids}, return_tensors="pt")
+    with torch.cuda.stream(copy_stream):
+        features = {
+            k: v.pin_memory().to(DEVICE, non_blocking=True) for k, v in features.items()
+        }
+        ready = torch.cuda.Event()
+        ready.record(copy_stream)
+    return features, ready
+
+
+def tokenize_batches(texts: List[str]):
+    # Like plan_batches, but tokenizes lazily, one chunk at a time. Texts are ordered by character count since token counts aren't known yet, so the first text in a batch isn't necessarily the longest.
+    order = sorted(range(len(texts)), key=lambda i: -len(texts[i]))
+    batch = []
+    batch_ids = []
+    longest = 0
+    for start in range(0, len(order), PIPELINE_TOKENIZE_CHUNK):
+        chunk = order[start : start + PIPELINE_TOKENIZE_CHUNK]
+        for i, ids in zip(chunk, tokenize([texts[i] for i in chunk])):
+            if batch and max(longest, len(ids)) * (len(batch) + 1) > BATCH_TOKENS:
+                yield batch, batch_ids
+                batch = []
+                batch_ids = []
+                longest = 0
+            batch.append(i)
+            batch_ids.append(ids)
+            longest = max(longest, len(ids))
+    if batch:
+        yield batch, batch_ids
+
+
+def produce_batches(texts: List[str], out: Queue):
+    # Runs on a tokenization thread, and hands each batch to another tokenization thread to pad and copy. `out` is bounded, so this stays at most PIPELINE_PREFETCH batches ahead of the model.
+    try:
+        for rows, input_ids in tokenize_batches(texts):
+            out.put((rows, tokenize_pool.submit(prepare_batch, input_ids)))
+    finally:
+        out.put(None)
+
+
+def process_lexical_weights(weights: np.ndarray, input_ids: np.ndarray):
+    # Equivalent to _process_token_weights in FlagEmbedding's BGEM3FlagModel.encode: the max weight of each token ID in the text, excluding special tokens and non-positive weights.
+    tokenizer = model.tokenizer
+    special = [
+        tokenizer.cls_token_id,
+        tokenizer.eos_token_id,
+        tokenizer.pad_token_id,
+        tokenizer.unk_token_id,
+    ]
+    res = []
+    for w, ids in zip(weights, input_ids):
+        keep = (w > 0) & ~np.isin(ids, special)
+        w, ids = w[keep], ids[keep]
+        order = np.lexsort((w, ids))
+        # After sorting by ID then weight, the last entry of each ID has its max weight.
+        last = np.append(ids[order][1:] != ids[order][:-1], True)
+        res.append(
+            {str(i): v for i, v in zip(ids[order][last].tolist(), w[order][last])}
+        )
+    return res
+
+
+def forward_batch(features: Dict[str, torch.Tensor]):
+    try:
+        return forward_features(features)
+    except torch.cuda.OutOfMemoryError:
+        count = features["input_ids"].shape[0]
+        if count == 1:
+            raise
+        # Like encode(), retry with a batch size 3/4 of the size, since BATCH_TOKENS may not fit in the VRAM currently free.
+        torch.cuda.empty_cache()
+        size = max(1, count * 3 // 4)
+        parts = [
+            forward_batch({k: v[start : start + size] for k, v in features.items()})
+            for start in range(0, count, size)
+        ]
+        dense_vecs = np.concatenate([d for d, _ in parts])
+        if parts[0][1] is None:
+            return dense_vecs, None
+        return dense_vecs, [w for _, l in parts for w in l]
+
+
+def forward_features(features: Dict[str, torch.Tensor]):
+    with torch.inference_mode():
+        if type(model) == BGEM3FlagModel:
+            out = model.model(features, return_dense=True, return_sparse=True)
+            dense_vecs = out["dense_vecs"].float().cpu().numpy()
+            lexical_weights = process_lexical_weights(
+                out["sparse_vecs"].squeeze(-1).float().cpu().numpy(),
+                features["input_ids"].cpu().numpy(),
+            )
+            return dense_vecs, lexical_weights
+        if type(model) == SentenceTransformer:
+            out = model(features)["sentence_embedding"]
+            out = torch.nn.functional.normalize(out, p=2, dim=1)
+            return out.float().cpu().numpy(), None
+    assert False
+
+
+def embed_texts_pipelined(texts: List[str]):
+    batches = Queue(PIPELINE_PREFETCH)
+    producer = tokenize_pool.submit(produce_batches, texts, batches)
+    parts = []
+    item = batches.get()
+    try:
+        while item is not None:
+            rows, prepared = item
+            features, ready = prepared.result()
+            stream = torch.cuda.current_stream()
+            stream.wait_event(ready)
+            for v in features.values():
+                # The tensors were allocated on the copy stream, so tell the allocator they're used on this stream too.
+                v.record_stream(stream)
+            parts.append((rows, forward_batch(features)))
+            item = batches.get()
+    finally:
+        # If anything failed, drain the queue, so the producer isn't blocked forever holding a thread.
+        while item is not None:
+            item = batches.get()
+    # Raise any tokenization error.
+    producer.result()
+    return merge_outputs(len(texts), parts)
+
+
+def embed_texts(texts: List[str]):
+    if PIPELINE:
+        return embed_texts_pipelined(texts)
+    input_ids = tokenize(texts)
+    return merge_outputs(
+        len(texts),
+        [
+            (batch, encode_batch([texts[i] for i in batch]))
+            for batch in plan_batches([len(ids) for ids in input_ids], BATCH_TOKENS)
+        ],
+    )
+
+
+def embed_texts_on_pool(texts: List[str]):
+    # Deal texts in length order, so every worker gets a similar amount of work.
+    order = sorted(range(len(texts)), key=lambda i: len(texts[i]))
+    parts = [p for p in (order[i::CPU_WORKERS] for i in range(CPU_WORKERS)) if p]
+    results = pool.map(embed_texts, [[texts[i] for i in p] for p in parts])
+    return merge_outputs(len(texts), list(zip(parts, results)))
+
+
+def pack_cache_value(dense: np.ndarray, lexical: Optional[Dict[str, np.ndarray]]):
+    # Layout: dim (uint32), dense vector (float32 * dim), then if BGE-M3, token IDs (uint32 * n) followed by their weights (float32 * n).
+    out = struct.pack("<I", dense.shape[0]) + dense.astype(np.float32).tobytes()
+    if lexical is not None:
+        out += np.fromiter((int(k) for k in lexical.keys()), np.uint32).tobytes()
+        out += np.fromiter(lexical.values(), np.float32).tobytes()
+    return out
+
+
+def unpack_cache_values(values: List[bytes]):
+    if not values:
+        return np.empty((0, 0), dtype=np.float32), [] if MODE == "bgem3" else None
+    (dim,) = struct.unpack_from("<I", values[0])
+    dense_vecs = np.empty((len(values), dim), dtype=np.float32)
+    lexical_weights = [] if MODE == "bgem3" else None
+    for i, v in enumerate(values):
+        dense_vecs[i] = np.frombuffer(v, np.float32, dim, 4)
+        if lexical_weights is not None:
+            n = (len(v) - 4 - dim * 4) // 8
+            ids = np.frombuffer(v, np.uint32, n, 4 + dim * 4)
+            weights = np.frombuffer(v, np.float32, n, 4 + dim * 4 + n * 4)
+            lexical_weights.append(dict(zip(map(str, ids.tolist()), weights)))
+    return dense_vecs, lexical_weights
+
+
+def embed_uncached(texts: List[str]):
+    if DEVICE == "cpu":
+        return embed_texts_on_pool(texts)
+    return embed_texts(texts)
+
+
+def embed_and_pack(texts: List[str]):
+    dense_vecs, lexical_weights = embed_uncached(texts)
+    return [
+        pack_cache_value(dense_vecs[i], lexical_weights and lexical_weights[i])
+        for i in range(len(texts))
+    ]
+
+
+last_embed_time = time.time()
+
+
+def embed_handler(x: EmbedReq):
+    global last_embed_time
+    embed_started = time.time()
+    statsd.timing("idle_gpu_ms", (embed_started - last_embed_time) * 1000)
+    if cache is not None:
+        values, computed = cache.map(x.texts, embed_and_pack)
+        dense_vecs, lexical_weights = unpack_cache_values(values)
+        statsd.incr("embed_text_cache_hit_count", len(x.texts) - computed)
     else:
-        assert False
+        dense_vecs, lexical_weights = embed_uncached(x.texts)
     embed_ended = time.time()
     statsd.timing("embed_text_ms", (embed_ended - embed_started) * 1000)
     statsd.incr("embed_text_input_count", len(x.texts))
     statsd.incr("embed_text_char_count", sum(len(t) for t in x.texts))
     last_embed_time = embed_ended
+    if x.compact:
+        lexical_raw = None
+        if lexical_weights is not None:
+            lexical_raw = [a.tobytes() for a in pack_lexical_weights(lexical_weights)]
+        return {
+            "embeddings_raw": dense_vecs.tobytes(),
+            "lexical_offsets_raw": lexical_raw and lexical_raw[0],
+            "lexical_ids_raw": lexical_raw and lexical_raw[1],
+            "lexical_weights_raw": lexical_raw and lexical_raw[2],
+        }
     return {
         # Avoid expensive and pointless tolist() -> msgpack.encode -> msgpack.decode -> new Float32Array -> new Uint8Array.
         "embeddings_raw": dense_vecs.tobytes(),
@@ -75,4 +384,18 @@ def embed_handler(x: EmbedReq):
     }
 
 
+if DEVICE == "cpu":
+    # Fork before loading anything, so each worker loads its own model and the parent stays light.
+    pool = mp.get_context("fork").Pool(CPU_WORKERS, initializer=init_cpu_worker)
+else:
+    init_model()
+    if PIPELINE:
+        tokenize_pool = ThreadPoolExecutor(PIPELINE_THREADS)
+        copy_stream = torch.cuda.Stream()
+
+cache = None
+if CACHE_PATH:
+    precision = "int8" if DEVICE == "cpu" and CPU_QUANTIZE else "fp32"
+    cache = TextCache(CACHE_PATH, f"{MODE}:{precision}")
+
 PyIpc().add_handler("embed", EmbedReq, embed_handler).begin_loop()
@@ -1,12 +1,30 @@
 import { createPyIpcQueue, spawnPyIpc } from "@msgpipe/nodejs";
-import {
-  VArray,
-  VBytes,
-  VFiniteNumber,
-  VObjectMap,
-  VOptional,
-  VStruct,
-} from "@wzlin/valid";
+import { VBytes, VOptional, VStruct } from "@wzlin/valid";
+import assertExists from "@xtjs/lib/assertExists";
+const { getFloat16 } = require("@petamoriken/float16");
+
+const dataView = (raw: Uint8Array) =>
+  new DataView(raw.buffer, raw.byteOffset, raw.byteLength);
+
+// The worker returns lexical weights in CSR form: the weights of text `i` are at [offsets[i], offsets[i + 1]) in the token ID (uint32) and weight (float16) arrays.
+const unpackLexicalWeights = (
+  count: number,
+  offsetsRaw: Uint8Array,
+  idsRaw: Uint8Array,
+  weightsRaw: Uint8Array,
+) => {
+  const offsets = dataView(offsetsRaw);
+  const ids = dataView(idsRaw);
+  const weights = dataView(weightsRaw);
+  return Array.from({ length: count }, (_, i) => {
+    const out: Record<string, number> = {};
+    const end = offsets.getUint32((i + 1) * 4, true);
+    for (let j = offsets.getUint32(i * 4, true); j < end; j++) {
+      out[ids.getUint32(j * 4, true)] = getFloat16(weights, j * 2, true);
+    }
+    return out;
+  });
+};
 
 export const createEmbedWorker = async (dim: number) => {
   const worker = await spawnPyIpc({
@@ -14,28 +32,71 @@ export const createEmbedWorker = async (dim: number) => {
     rootDir: `${__dirname}/../`,
   });
   const queue = createPyIpcQueue(worker);
-  return {
-    embed: async (texts: string[]) => {
-      const embLenRaw = dim * 4;
-      const rawLen = embLenRaw * texts.length;
-      const res = await queue.request(
-        "embed",
-        { texts },
-        new VStruct({
-          embeddings_raw: new VBytes(rawLen, rawLen),
-          lexical_weights: new VOptional(
-            new VArray(
-              new VObjectMap(new VFiniteNumber()),
-              texts.length,
-              texts.length,
-            ),
-          ),
-        }),
+  const embLenRaw = dim * 4;
+  const embedRaw = async (texts: string[]) => {
+    const rawLen = embLenRaw * texts.length;
+    const offsetsLen = (texts.length + 1) * 4;
+    const res = await queue.request(
+      "embed",
+      { texts, compact: true },
+      new VStruct({
+        embeddings_raw: new VBytes(rawLen, rawLen),
+        lexical_offsets_raw: new VOptional(new VBytes(offsetsLen, offsetsLen)),
+        lexical_ids_raw: new VOptional(new VBytes()),
+        lexical_weights_raw: new VOptional(new VBytes()),
+      }),
+    );
+    const sparse =
+      res.lexical_offsets_raw &&
+      unpackLexicalWeights(
+        texts.length,
+        res.lexical_offsets_raw,
+        assertExists(res.lexical_ids_raw),
+        assertExists(res.lexical_weights_raw),
       );
-      return texts.map((_, i) => ({
-        dense: res.embeddings_raw.slice(i * embLenRaw, (i + 1) * embLenRaw),
-        sparse: res.lexical_weights?.at(i),
-      }));
-    },
+    return texts.map((_, i) => ({
+      dense: res.embeddings_raw.slice(i * embLenRaw, (i + 1) * embLenRaw),
+      sparse: sparse?.at(i),
+    }));
+  };
+
+  type Embedding = Awaited<ReturnType<typeof embedRaw>>[number];
+  // Requests made while the worker is busy are coalesced into one request, so the worker gets fewer, larger requests that it can batch by length much more efficiently than many small ones.
+  let pending: Array<{
+    texts: string[];
+    resolve: (res: Embedding[]) => void;
+    reject: (err: unknown) => void;
+  }> = [];
+  let busy = false;
+  const flush = async () => {
+    if (busy || !pending.length) {
+      return;
+    }
+    busy = true;
+    const reqs = pending;
+    pending = [];
+    try {
+      const res = await embedRaw(reqs.flatMap((r) => r.texts));
+      let start = 0;
+      for (const r of reqs) {
+        r.resolve(res.slice(start, start + r.texts.length));
+        start += r.texts.length;
+      }
+    } catch (err) {
+      for (const r of reqs) {
+        r.reject(err);
+      }
+    } finally {
+      busy = false;
+      void flush();
+    }
+  };
+
+  return {
+    embed: (texts: string[]) =>
+      new Promise<Embedding[]>((resolve, reject) => {
+        pending.push({ texts, resolve, reject });
+        void flush();
+      }),
   };
 };
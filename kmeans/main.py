@@ -1,7 +1,13 @@
 from common.emb_data import load_embs
+from common.kmeans import spherical_kmeans
 from sklearn.cluster import MiniBatchKMeans
+from threadpoolctl import threadpool_limits
+from typing import List
+from typing import Optional
+from typing import Union
 import json
 import multiprocessing as mp
+import numpy as np
 import os
 import pandas as pd
 import time
@@ -14,57 +20,185 @@ if nt > 64:
         "OpenBLAS does not support more than 64 threads, will result in a crash"
     )
 
-DATASET = "toppost"
+# The embeddings to cluster. build-api-data uses the results for each dataset in BUILD_API_DATA_CLUSTERS, so run this once per dataset there.
+DATASET = os.getenv("KMEANS_DATASET", "toppost")
 K_MIN = int(os.getenv("K_MIN", "2"))
 K_MAX = int(os.getenv("K_MAX", "5000"))
+# Instead of trying every k in [K_MIN, K_MAX), first try this many k values spaced geometrically across the range, then try K_REFINE_STEPS more values around the elbow of the inertia curve. Set K_COARSE_STEPS to at least K_MAX - K_MIN to try every k.
+K_COARSE_STEPS = int(os.getenv("K_COARSE_STEPS", "48"))
+K_REFINE_STEPS = int(os.getenv("K_REFINE_STEPS", "32"))
+WORKERS = int(os.getenv("KMEANS_WORKERS", str(min(8, nt))))
+# "minibatch" uses scikit-learn's MiniBatchKMeans. "spherical" uses our own spherical k-means (common.kmeans), which is much faster for our unit-normalized embeddings.
+IMPL = os.getenv("KMEANS_IMPL", "minibatch")
+# How many rows to sample when picking the additional centroids for a warm start.
+WARM_START_SAMPLE = 100_000
 
 d = f"/hndr-data/kmeans-{DATASET}"
 os.makedirs(d, exist_ok=True)
 
+# Load once in the parent process. The workers are forked, so they share this memory mapping instead of each reloading the embeddings for every k.
+mat_id, mat_emb = load_embs(DATASET)
 
-def calc_kmeans(k: int):
+_threadpool_limiter = None
+
+
+def init_worker():
+    global _threadpool_limiter
+    # Otherwise, each worker's BLAS spawns `nt` threads, oversubscribing the CPU by a factor of WORKERS.
+    _threadpool_limiter = threadpool_limits(max(1, nt // WORKERS))
+
+
+def load_result(k: int) -> Optional[dict]:
     f_json = f"{d}/k{k}.json"
-    if os.path.isfile(f_json):
-        return
+    if not os.path.isfile(f_json):
+        return None
+    with open(f_json) as f:
+        return json.load(f)
 
-    print("Loading data")
-    mat_id, mat_emb = load_embs(DATASET)
 
+def warm_start_init(prev_centers: np.ndarray, k: int, rng: np.random.Generator):
+    # Keep the centroids from a smaller k, and pick the additional ones from a sample of rows using the k-means++ weighting (squared distance to the nearest existing centroid).
+    n = mat_emb.shape[0]
+    sample = mat_emb[np.sort(rng.choice(n, min(n, WARM_START_SAMPLE), replace=False))]
+    dists = (
+        (sample**2).sum(axis=1)[:, None]
+        - 2 * (sample @ prev_centers.T)
+        + (prev_centers**2).sum(axis=1)[None, :]
+    )
+    weights = dists.min(axis=1).clip(min=0)
+    extra = k - prev_centers.shape[0]
+    if np.count_nonzero(weights) < extra:
+        # Most rows coincide with an existing centroid, so just pick uniformly.
+        weights = np.ones_like(weights)
+    rows = rng.choice(sample.shape[0], extra, replace=False, p=weights / weights.sum())
+    return np.vstack([prev_centers, sample[rows]]).astype(np.float32)
+
+
+def calc_kmeans(k: int, init: Union[str, np.ndarray]):
     print("K-clustering", k)
     started = time.time()
-    # fit_predict just returns `.fit(X).labels_` (check the source code).
-    km = MiniBatchKMeans(
-        init="k-means++",
-        n_clusters=k,
-        # https://stackoverflow.com/a/23527049
-        reassignment_ratio=0,
-        max_iter=300,
-    ).fit(mat_emb)
+    if IMPL == "spherical":
+        res = spherical_kmeans(
+            mat_emb, k, init=init if isinstance(init, np.ndarray) else None
+        )
+        labels = res.labels
+        cluster_centers = res.cluster_centers
+        inertia = res.inertia
+        iters = res.n_iter
+        # Every iteration is a full pass.
+        steps = res.n_iter
+    elif IMPL == "minibatch":
+        # fit_predict just returns `.fit(X).labels_` (check the source code).
+        km = MiniBatchKMeans(
+            init=init,
+            # An explicit init is deterministic, so there's no point running it more than once.
+            n_init=1 if isinstance(init, np.ndarray) else "auto",
+            n_clusters=k,
+            # https://stackoverflow.com/a/23527049
+            reassignment_ratio=0,
+            max_iter=300,
+        ).fit(mat_emb)
+        labels = km.labels_
+        cluster_centers = km.cluster_centers_
+        inertia = km.inertia_
+        iters = km.n_iter_
+        steps = km.n_steps_
+    else:
+        raise ValueError(f"Unknown k-means implementation: {IMPL}")
     elapsed = time.time() - started
     print(f"K-clustering {k} done in {elapsed:.2f} seconds")
 
     # We can't use silhouette score, since that requires O(n^2) computations and memory for pairwise distances. It's too slow and expensive. We'll just use the inertia value. Even if we precompute ourselves using the dot product, we run out of memory (~500K ^ 2 is huge). https://datascience.stackexchange.com/a/36074
 
     # One element per input row, representing the ID of the cluster that input row is in, where a cluster ID is an integer in the range [0, k).
-    df = pd.DataFrame({"id": mat_id, f"k{k}_cluster": km.labels_})
+    df = pd.DataFrame({"id": mat_id, f"k{k}_cluster": labels})
 
     df.to_feather(f"{d}/k{k}_cluster.arrow")
+    f_json = f"{d}/k{k}.json"
     with open(f"{f_json}.tmp", "w") as f:
         json.dump(
             {
-                "cluster_centers": km.cluster_centers_.tolist(),
-                "inertia": km.inertia_,
-                "iters": km.n_iter_,
+                "cluster_centers": cluster_centers.tolist(),
+                "impl": IMPL,
+                "inertia": inertia,
+                "iters": iters,
                 "k": k,
-                "steps": km.n_steps_,
+                "steps": steps,
                 "train_time_sec": elapsed,
+                "warm_start": isinstance(init, np.ndarray),
             },
             f,
         )
     os.rename(f"{f_json}.tmp", f_json)
     print("Saved", k)
+    return cluster_centers
 
 
-with mp.Pool() as p:
-    p.map(calc_kmeans, range(K_MIN, K_MAX))
+def run_chain(ks: List[int]):
+    # `ks` is ascending, so each k can be warm started from the previous k's centroids, which converges in far fewer iterations than starting from scratch.
+    rng = np.random.default_rng()
+    prev_centers = None
+    for k in ks:
+        res = load_result(k)
+        if res is not None:
+            prev_centers = np.array(res["cluster_centers"], dtype=np.float32)
+            continue
+        try:
+            if prev_centers is None:
+                init = "k-means++"
+            else:
+                init = warm_start_init(prev_centers, k, rng)
+            prev_centers = calc_kmeans(k, init)
+        except Exception as e:
+            # Don't lose the rest of the chain (e.g. k is more than the number of rows). This k has no result, so it's skipped when finding the elbow, and the next k warm starts from the last k that succeeded.
+            print(f"K-clustering {k} failed:", repr(e))
+
+
+def run_sweep(ks: List[int], warm_from: Optional[int] = None):
+    ks = sorted(set(ks))
+    # Interleave so that every chain spans the whole range and has roughly the same amount of work.
+    chains = [ks[i::WORKERS] for i in range(WORKERS)]
+    if warm_from is not None:
+        # Start each chain from an already computed smaller k, so that even the first k in each chain is warm started.
+        chains = [[warm_from] + c for c in chains]
+    with mp.get_context("fork").Pool(WORKERS, initializer=init_worker) as p:
+        p.map(run_chain, [c for c in chains if c], chunksize=1)
+
+
+def find_elbow(ks: List[int], inertias: List[float]) -> int:
+    # Return the index of the point furthest below the chord between the first and last points, using log k (as ks are spaced geometrically) and both axes normalized to [0, 1].
+    x = np.log(np.array(ks, dtype=np.float64))
+    y = np.array(inertias, dtype=np.float64)
+    x = (x - x[0]) / max(x[-1] - x[0], 1e-12)
+    y = (y - y[-1]) / max(y[0] - y[-1], 1e-12)
+    return int(np.argmax((1 - x) - y))
+
+
+if K_COARSE_STEPS >= K_MAX - K_MIN:
+    coarse_ks = list(range(K_MIN, K_MAX))
+else:
+    coarse_ks = sorted(
+        set(np.geomspace(K_MIN, K_MAX - 1, K_COARSE_STEPS).round().astype(int).tolist())
+    )
+print("Coarse pass:", coarse_ks)
+run_sweep(coarse_ks)
+
+# Only keep the inertias, as the results also contain every centroid.
+coarse_inertias = {}
+for k in coarse_ks:
+    res = load_result(k)
+    if res is not None:
+        coarse_inertias[k] = res["inertia"]
+failed_ks = [k for k in coarse_ks if k not in coarse_inertias]
+if failed_ks:
+    print("No results for", failed_ks, "; ignoring them when finding the elbow")
+coarse_ks = list(coarse_inertias.keys())
+if len(coarse_ks) >= 3 and K_REFINE_STEPS:
+    inertias = list(coarse_inertias.values())
+    i = find_elbow(coarse_ks, inertias)
+    lo = coarse_ks[max(0, i - 1)]
+    hi = coarse_ks[min(len(coarse_ks) - 1, i + 1)]
+    refine_ks = np.linspace(lo, hi, K_REFINE_STEPS).round().astype(int).tolist()
+    print("Elbow around", coarse_ks[i], "; refining pass:", sorted(set(refine_ks)))
+    run_sweep(refine_ks, warm_from=lo)
 print("All done!")
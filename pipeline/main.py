@@ -0,0 +1,395 @@
+"""
+Runs the offline pipeline stages (each a standalone `{stage}/main.py` script reading and writing /hndr-data), skipping stages whose outputs are already up to date, and running independent stages in parallel.
+
+A stage is up to date if all its outputs exist and the fingerprint of its inputs, script, the shared modules in common/, and config is the same as the last time it succeeded. Fingerprints are stored in /hndr-data/pipeline-state.json. Since a stage's outputs are the inputs of the stages after it, rerunning a stage changes their fingerprints, so everything downstream of a changed file is rerun, and nothing else.
+"""
+
+from concurrent.futures import FIRST_COMPLETED
+from concurrent.futures import Future
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import wait
+from dataclasses import dataclass
+from dataclasses import field
+from fnmatch import fnmatch
+from typing import Dict
+from typing import List
+from typing import Set
+import glob
+import hashlib
+import json
+import multiprocessing as mp
+import os
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+STATE_PATH = "/hndr-data/pipeline-state.json"
+LOG_DIR = "/hndr-data/pipeline-logs"
+# Comma-separated stages to run, along with all the stages they depend on. Defaults to every stage.
+TARGETS = [s for s in os.getenv("PIPELINE_STAGES", "").split(",") if s]
+# Run the selected stages even if they're up to date.
+FORCE = os.getenv("PIPELINE_FORCE", "0") == "1"
+# Only print what would be run.
+DRY_RUN = os.getenv("PIPELINE_DRY_RUN", "0") == "1"
+# Stages are only started while the sum of their declared requirements is within these limits. A stage that needs more than the limit on its own is run by itself.
+CPU_LIMIT = int(os.getenv("PIPELINE_CPUS", str(mp.cpu_count())))
+MEM_LIMIT_GIB = int(
+    os.getenv(
+        "PIPELINE_MEM_GIB",
+        str(os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") // 1024**3),
+    )
+)
+# Rather than hashing entire multi-GB files, hash this many evenly spaced blocks of each file (always including the first and last), alongside its size and mtime. This catches rewrites that preserve the size and mtime, without reading more than a few MiB per file.
+SAMPLE_BLOCKS = 16
+SAMPLE_BLOCK_SIZE = 64 * 1024
+
+
+@dataclass
+class Stage:
+    name: str
+    # Paths relative to /hndr-data. A directory covers every file within it.
+    inputs: List[str]
+    # Paths relative to /hndr-data, which may be glob patterns (which must match at least one file).
+    outputs: List[str]
+    cpus: int
+    mem_gib: int
+    # Environment variables with these prefixes configure the stage, so changing them makes the stage stale.
+    env_prefixes: List[str] = field(default_factory=list)
+
+
+def emb_files(name: str):
+    return [f"{name}-embs-ids.mat", f"{name}-embs-data.mat"]
+
+
+def umap_files(name: str):
+    return [f"umap-{name}-emb.mat", f"umap-{name}-ids.mat"]
+
+
+def umap_knn_files(name: str):
+    return [
+        f"umap-{name}-knn-embs.mat",
+        f"umap-{name}-knn-coords.mat",
+        f"umap-{name}-knn.json",
+    ]
+
+
+def parse_dataset_ints(var: str) -> Dict[str, int]:
+    # Same format as build-api-data.
+    return {
+        name: int(v)
+        for name, v in (e.split("=") for e in os.getenv(var, "").split(",") if e)
+    }
+
+
+UMAP_DATASET = os.getenv("UMAP_DATASET", "toppost")
+KMEANS_DATASET = os.getenv("KMEANS_DATASET", "toppost")
+EDGE_DATA_MAPS = os.getenv("EDGE_DATA_MAPS", "toppost").split(",")
+CPUS = mp.cpu_count()
+
+STAGES = [
+    Stage(
+        name="build-ann",
+        inputs=emb_files("toppost"),
+        outputs=["ann-toppost.pickle", "ann-toppost-ids.mat"],
+        cpus=CPUS,
+        mem_gib=32,
+    ),
+    Stage(
+        name="kmeans",
+        inputs=emb_files(KMEANS_DATASET),
+        outputs=[f"kmeans-{KMEANS_DATASET}"],
+        cpus=CPUS,
+        mem_gib=16,
+        env_prefixes=["K_", "KMEANS_"],
+    ),
+    Stage(
+        name="umap",
+        inputs=[
+            *emb_files(UMAP_DATASET),
+            # Fitting on everything reuses the ANN index's neighbor graph.
+            *(
+                []
+                if int(os.getenv("UMAP_FIT_SAMPLE", "0"))
+                else [f"ann-{UMAP_DATASET}.pickle", f"ann-{UMAP_DATASET}-ids.mat"]
+            ),
+        ],
+        outputs=[
+            *umap_files(UMAP_DATASET),
+            *umap_knn_files(UMAP_DATASET),
+            f"umap-{UMAP_DATASET}-model.joblib",
+        ],
+        cpus=CPUS,
+        mem_gib=64,
+        env_prefixes=["UMAP_"],
+    ),
+    Stage(
+        name="build-map",
+        inputs=[
+            *umap_files("toppost"),
+            *umap_knn_files("toppost"),
+            "posts.arrow",
+        ],
+        outputs=["map-toppost.msgpack"],
+        cpus=4,
+        mem_gib=16,
+        env_prefixes=["MAP_", "TERRAIN_"],
+    ),
+    Stage(
+        name="build-api-data",
+        inputs=[
+            "posts.arrow",
+            "comments.arrow",
+            "users.arrow",
+            "comment_sentiments.arrow",
+            *emb_files("post"),
+            *emb_files("toppost"),
+            *emb_files("comment"),
+            *umap_files("toppost"),
+            *(
+                f"kmeans-{name}/k{k}{ext}"
+                for name, k in parse_dataset_ints("BUILD_API_DATA_CLUSTERS").items()
+                for ext in ("_cluster.arrow", ".json")
+            ),
+        ],
+        outputs=[
+            f"api-{name}-{suffix}"
+            for name in ("post", "toppost", "comment")
+            for suffix in ("table.feather", "meta.json", "emb.mat")
+        ],
+        cpus=CPUS,
+        mem_gib=64,
+        env_prefixes=["BUILD_API_DATA_"],
+    ),
+    Stage(
+        name="build-edge-data",
+        inputs=[
+            *(f for name in EDGE_DATA_MAPS for f in umap_files(name)),
+            *(f"map-{name}.msgpack" for name in EDGE_DATA_MAPS),
+            "posts.arrow",
+            "users.arrow",
+            "urls.arrow",
+            "post_titles.arrow",
+            "url_metas.arrow",
+        ],
+        outputs=[
+            (
+                "edge/index.json"
+                if os.getenv("EDGE_DATA_FORMAT", "msgpack") == "arrow"
+                else "edge.msgpack"
+            )
+        ],
+        cpus=2,
+        mem_gib=32,
+        env_prefixes=["EDGE_DATA_"],
+    ),
+]
+
+
+def list_files(path: str) -> List[str]:
+    full = f"/hndr-data/{path}"
+    if os.path.isdir(full):
+        return sorted(
+            os.path.join(dirpath, f)
+            for dirpath, _, files in os.walk(full)
+            for f in files
+        )
+    if os.path.exists(full):
+        return [full]
+    raise FileNotFoundError(full)
+
+
+def fingerprint_file(path: str, h):
+    st = os.stat(path)
+    h.update(f"{path}\0{st.st_size}\0{st.st_mtime_ns}\0".encode())
+    blocks = max(1, min(SAMPLE_BLOCKS, -(-st.st_size // SAMPLE_BLOCK_SIZE)))
+    with open(path, "rb") as f:
+        for i in range(blocks):
+            offset = (st.st_size - SAMPLE_BLOCK_SIZE) * i // max(1, blocks - 1)
+            f.seek(max(0, offset))
+            h.update(f.read(SAMPLE_BLOCK_SIZE))
+
+
+def fingerprint_stage(stage: Stage) -> str:
+    h = hashlib.blake2b(digest_size=16)
+    for path in sorted(stage.inputs):
+        for f in list_files(path):
+            fingerprint_file(f, h)
+    # Stages import shared code from common/, and tracing exactly which modules each one uses isn't worth it, so any change there reruns every stage.
+    for path in [
+        f"{ROOT}/{stage.name}/main.py",
+        *sorted(glob.glob(f"{ROOT}/common/*.py")),
+    ]:
+        h.update(f"{os.path.relpath(path, ROOT)}\0".encode())
+        with open(path, "rb") as f:
+            h.update(f.read())
+    for k, v in sorted(os.environ.items()):
+        if any(k.startswith(p) for p in stage.env_prefixes):
+            h.update(f"{k}={v}\0".encode())
+    return h.hexdigest()
+
+
+def outputs_exist(stage: Stage) -> bool:
+    return all(glob.glob(f"/hndr-data/{p}") for p in stage.outputs)
+
+
+def produces(upstream: Stage, path: str) -> bool:
+    return any(
+        fnmatch(path, out) or path.startswith(f"{out}/") for out in upstream.outputs
+    )
+
+
+def get_deps(stages: List[Stage]) -> Dict[str, Set[str]]:
+    return {
+        s.name: {
+            u.name
+            for u in stages
+            if u is not s and any(produces(u, i) for i in s.inputs)
+        }
+        for s in stages
+    }
+
+
+def select_stages(deps: Dict[str, Set[str]]) -> Set[str]:
+    if not TARGETS:
+        return set(deps)
+    unknown = set(TARGETS) - set(deps)
+    if unknown:
+        raise ValueError(f"Unknown stages: {sorted(unknown)}")
+    out = set()
+    pending = list(TARGETS)
+    while pending:
+        name = pending.pop()
+        if name not in out:
+            out.add(name)
+            pending.extend(deps[name])
+    return out
+
+
+def load_state() -> Dict[str, str]:
+    try:
+        with open(STATE_PATH) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def dump_state(state: Dict[str, str]):
+    with open(f"{STATE_PATH}.tmp", "w") as f:
+        json.dump(state, f, indent=2)
+    os.rename(f"{STATE_PATH}.tmp", STATE_PATH)
+
+
+def run_stage(stage: Stage) -> int:
+    with open(f"{LOG_DIR}/{stage.name}.log", "wb") as log:
+        return subprocess.run(
+            [sys.executable, f"{ROOT}/{stage.name}/main.py"],
+            cwd=ROOT,
+            env={
+                **os.environ,
+                "PYTHONPATH": ROOT,
+                "PYTHONUNBUFFERED": "1",
+                # Otherwise, each stage's BLAS and OpenMP use every core, oversubscribing the CPU when stages run in parallel.
+                "OMP_NUM_THREADS": str(stage.cpus),
+                "OPENBLAS_NUM_THREADS": str(min(64, stage.cpus)),
+                "MKL_NUM_THREADS": str(stage.cpus),
+            },
+            stdout=log,
+            stderr=subprocess.STDOUT,
+        ).returncode
+
+
+def main():
+    stages = {s.name: s for s in STAGES}
+    deps = get_deps(STAGES)
+    selected = select_stages(deps)
+    state = load_state()
+    os.makedirs(LOG_DIR, exist_ok=True)
+
+    done: Set[str] = set()
+    failed: Set[str] = set()
+    # Stages that were (or, for a dry run, would be) rerun.
+    rerun: Set[str] = set()
+    fingerprints: Dict[str, str] = {}
+    running: Dict[Future, str] = {}
+    started: Dict[str, float] = {}
+    cpus_used = 0
+    mem_used = 0
+    with ThreadPoolExecutor(len(stages)) as pool:
+        while True:
+            # Skip or start every stage whose dependencies are done, in declaration order.
+            for name, stage in stages.items():
+                if (
+                    name not in selected
+                    or name in done
+                    or name in failed
+                    or name in started
+                    or not deps[name] <= done
+                ):
+                    continue
+                if DRY_RUN and deps[name] & rerun:
+                    # The inputs haven't been rebuilt yet, so they can't be fingerprinted.
+                    print(f"[{name}] Would run after {sorted(deps[name] & rerun)}")
+                    done.add(name)
+                    rerun.add(name)
+                    continue
+                if name not in fingerprints:
+                    try:
+                        fingerprints[name] = fingerprint_stage(stage)
+                    except FileNotFoundError as e:
+                        print(f"[{name}] Missing input {e}")
+                        failed.add(name)
+                        continue
+                    if (
+                        not FORCE
+                        and state.get(name) == fingerprints[name]
+                        and outputs_exist(stage)
+                    ):
+                        print(f"[{name}] Up to date")
+                        done.add(name)
+                        continue
+                if DRY_RUN:
+                    print(f"[{name}] Would run")
+                    done.add(name)
+                    rerun.add(name)
+                    continue
+                if running and (
+                    cpus_used + stage.cpus > CPU_LIMIT
+                    or mem_used + stage.mem_gib > MEM_LIMIT_GIB
+                ):
+                    continue
+                print(f"[{name}] Running, logging to {LOG_DIR}/{name}.log")
+                running[pool.submit(run_stage, stage)] = name
+                started[name] = time.time()
+                cpus_used += stage.cpus
+                mem_used += stage.mem_gib
+            if not running:
+                break
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for fut in finished:
+                name = running.pop(fut)
+                cpus_used -= stages[name].cpus
+                mem_used -= stages[name].mem_gib
+                elapsed = time.time() - started[name]
+                code = fut.result()
+                if code != 0:
+                    print(f"[{name}] Failed with code {code} after {elapsed:.0f}s")
+                    failed.add(name)
+                    continue
+                print(f"[{name}] Done in {elapsed:.0f}s")
+                done.add(name)
+                rerun.add(name)
+                # Record the fingerprint from before the stage ran, so that if an input changed while it was running, it's rerun next time.
+                state[name] = fingerprints[name]
+                dump_state(state)
+
+    blocked = selected - done - failed
+    if blocked:
+        print("Not run due to failed dependencies:", sorted(blocked))
+    if failed or blocked:
+        sys.exit(1)
+    print("All done!")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,12 +1,16 @@
+from common.text_cache import TextCache
+from common.util import plan_batches
 from dataclasses import dataclass
 from msgpipe import PyIpc
-from scipy.special import softmax
 from service_toolkit.panic import set_excepthook
 from statsd import StatsClient
 from transformers import AutoConfig
 from transformers import AutoModelForSequenceClassification
 from transformers import AutoTokenizer
 from typing import List
+import multiprocessing as mp
+import numpy as np
+import numpy.typing as npt
 import os
 import time
 import torch
@@ -17,50 +21,135 @@ statsd = StatsClient("localhost", 8125, prefix=os.getenv("MAIN"))
 
 MODEL = f"cardiffnlp/twitter-roberta-base-sentiment-latest"
 
+# "cuda" or "cpu". On CPU, requests are split across a pool of worker processes, each with its own copy of the model.
+DEVICE = os.getenv("HNDR_SENTIMENT_DEVICE", "cuda")
+CPU_WORKERS = int(
+    os.getenv("HNDR_SENTIMENT_CPU_WORKERS", str(max(1, mp.cpu_count() // 4)))
+)
+# Quantize linear layers to int8 when running on CPU. This is usually 2-4x faster, with a small loss in accuracy.
+CPU_QUANTIZE = os.getenv("HNDR_SENTIMENT_CPU_QUANTIZE", "1") == "1"
+
+MAX_LENGTH = 512
+# If set, scores are cached in a SQLite database at this path, keyed by a hash of the text, and duplicate texts are never scored again.
+CACHE_PATH = os.getenv("HNDR_SENTIMENT_CACHE_PATH", "")
+
 tokenizer = AutoTokenizer.from_pretrained(MODEL)
 config = AutoConfig.from_pretrained(MODEL)
-model = AutoModelForSequenceClassification.from_pretrained(MODEL).to("cuda")
+LABELS = [config.id2label[k] for k in range(config.num_labels)]
+model = None
+
+
+def init_model():
+    global model
+    model = AutoModelForSequenceClassification.from_pretrained(MODEL).to(DEVICE)
+    if DEVICE == "cpu" and CPU_QUANTIZE:
+        # Dynamic quantization stores the weights as int8 and quantizes activations on the fly, so it doesn't need calibration data.
+        torch.quantization.quantize_dynamic(
+            model, {torch.nn.Linear}, dtype=torch.qint8, inplace=True
+        )
 
-# Comments can vary in length dramatically, so padding will cause a quadratic jump in VRAM requirements if just one comment is very long.
-# Also, many GPUs have less than 16 GB VRAM.
-# Also, after a certain batch size, the performance does not increase.
-# Therefore, tune batch size well.
-total_vram_bytes = torch.cuda.get_device_properties(0).total_memory
-total_vram_gib = total_vram_bytes / (1024**3)
-BATCH_SIZE = round(0.75 * total_vram_gib)
-print("VRAM:", total_vram_gib, "GiB")
-print("Batch size:", BATCH_SIZE)
+
+def init_cpu_worker():
+    # Otherwise, every worker uses every core, oversubscribing the CPU by a factor of CPU_WORKERS.
+    torch.set_num_threads(max(1, mp.cpu_count() // CPU_WORKERS))
+    init_model()
+
+
+if DEVICE == "cuda":
+    # Comments can vary in length dramatically, so padding will cause a quadratic jump in VRAM requirements if just one comment is very long. Therefore, we sort texts by length and limit the total tokens (including padding) in each batch, rather than the number of texts.
+    # Also, many GPUs have less than 16 GB VRAM.
+    # Also, after a certain batch size, the performance does not increase.
+    # Therefore, tune batch size well.
+    total_vram_bytes = torch.cuda.get_device_properties(0).total_memory
+    total_vram_gib = total_vram_bytes / (1024**3)
+    # This is the same worst case as the previous limit of round(0.75 * total_vram_gib) texts of MAX_LENGTH tokens.
+    BATCH_TOKENS = round(0.75 * total_vram_gib) * MAX_LENGTH
+    print("VRAM:", total_vram_gib, "GiB")
+else:
+    BATCH_TOKENS = int(os.getenv("HNDR_SENTIMENT_CPU_BATCH_TOKENS", "8192"))
+print("Batch tokens:", BATCH_TOKENS)
 
 
 @dataclass
 class ModelReq:
     texts: List[str]
+    # If true, scores are returned as a packed float32 matrix of shape (len(texts), len(labels)) instead of a list of dicts.
+    compact: bool = False
+
+
+def score_texts(texts: List[str]) -> npt.NDArray[np.float32]:
+    # Tokenize once without padding to get the lengths, then pad each batch separately.
+    input_ids = tokenizer(texts, truncation=True, max_length=MAX_LENGTH)["input_ids"]
+    probs = np.empty((len(texts), len(LABELS)), dtype=np.float32)
+    for batch in plan_batches([len(ids) for ids in input_ids], BATCH_TOKENS):
+        encoded_input = tokenizer.pad(
+            {"input_ids": [input_ids[i] for i in batch]}, return_tensors="pt"
+        ).to(DEVICE)
+        with torch.inference_mode(), torch.autocast(
+            device_type=DEVICE, dtype=torch.float16, enabled=DEVICE == "cuda"
+        ):
+            logits = model(**encoded_input).logits
+        # Make sure to apply softmax to each row, not to an entire batch matrix.
+        probs[batch] = torch.softmax(logits.float(), dim=1).cpu().numpy()
+    return probs
+
+
+def score_texts_on_pool(texts: List[str]):
+    # Deal texts in length order, so every worker gets a similar amount of work.
+    order = sorted(range(len(texts)), key=lambda i: len(texts[i]))
+    parts = [p for p in (order[i::CPU_WORKERS] for i in range(CPU_WORKERS)) if p]
+    probs = np.empty((len(texts), len(LABELS)), dtype=np.float32)
+    for p, part_probs in zip(
+        parts, pool.map(score_texts, [[texts[i] for i in p] for p in parts])
+    ):
+        probs[p] = part_probs
+    return probs
+
+
+def score_uncached(texts: List[str]):
+    if DEVICE == "cpu":
+        return score_texts_on_pool(texts)
+    return score_texts(texts)
 
 
 def model_handler(x: ModelReq):
     started = time.time()
-    res = []
-    for i in range(0, len(x.texts), BATCH_SIZE):
-        batch = x.texts[i : i + BATCH_SIZE]
-        encoded_input = tokenizer(
-            batch, return_tensors="pt", padding=True, truncation=True, max_length=512
-        ).to("cuda")
-        output = model(**encoded_input)
-        scores = output.logits.detach().cpu().numpy()
-        for j in range(len(batch)):
-            res.append(
-                {
-                    config.id2label[k]: score
-                    # Make sure to apply softmax to each row, not to an entire batch matrix.
-                    for k, score in enumerate(softmax(scores[j]).tolist())
-                }
-            )
+    if cache is not None:
+        values, computed = cache.map(
+            x.texts, lambda texts: [row.tobytes() for row in score_uncached(texts)]
+        )
+        probs = np.frombuffer(b"".join(values), dtype=np.float32).reshape(
+            len(x.texts), len(LABELS)
+        )
+        statsd.incr("model_cache_hit_count", len(x.texts) - computed)
+    else:
+        probs = score_uncached(x.texts)
     statsd.timing("model_ms", (time.time() - started) * 1000)
     statsd.incr("model_input_count", len(x.texts))
     statsd.incr("model_char_count", sum(len(t) for t in x.texts))
+    if x.compact:
+        return {
+            "labels": LABELS,
+            "scores_raw": probs.tobytes(),
+        }
     return {
-        "scores": res,
+        "scores": [dict(zip(LABELS, row)) for row in probs.tolist()],
     }
 
 
+if DEVICE == "cpu":
+    # Fork before loading the model, so each worker loads its own model and the parent stays light.
+    pool = mp.get_context("fork").Pool(CPU_WORKERS, initializer=init_cpu_worker)
+else:
+    init_model()
+
+cache = None
+if CACHE_PATH:
+    if DEVICE == "cuda":
+        # The model runs under float16 autocast.
+        precision = "fp16"
+    else:
+        precision = "int8" if CPU_QUANTIZE else "fp32"
+    cache = TextCache(CACHE_PATH, f"{MODEL}:{precision}")
+
 PyIpc().add_handler("model", ModelReq, model_handler).begin_loop()
@@ -1,5 +1,5 @@
 import { createPyIpcQueue, spawnPyIpc } from "@msgpipe/nodejs";
-import { VArray, VFiniteNumber, VStruct } from "@wzlin/valid";
+import { VArray, VBytes, VString, VStruct } from "@wzlin/valid";
 
 export const createModel = async () => {
   const worker = await spawnPyIpc({
@@ -9,22 +9,35 @@ export const createModel = async () => {
   const queue = createPyIpcQueue(worker);
   return {
     execute: async (texts: string[]) => {
-      const { scores } = await queue.request(
+      const { labels, scores_raw } = await queue.request(
         "model",
-        { texts },
+        { texts, compact: true },
         new VStruct({
-          scores: new VArray(
-            new VStruct({
-              negative: new VFiniteNumber(),
-              neutral: new VFiniteNumber(),
-              positive: new VFiniteNumber(),
-            }),
-            texts.length,
-            texts.length,
-          ),
+          labels: new VArray(new VString()),
+          // A float32 matrix of shape (texts.length, labels.length).
+          scores_raw: new VBytes(),
         }),
       );
-      return texts.map((_, i) => scores[i]);
+      const dv = new DataView(
+        scores_raw.buffer,
+        scores_raw.byteOffset,
+        scores_raw.byteLength,
+      );
+      if (dv.byteLength !== texts.length * labels.length * 4) {
+        throw new Error(`Unexpected scores size: ${dv.byteLength}`);
+      }
+      const score = (i: number, label: string) => {
+        const j = labels.indexOf(label);
+        if (j < 0) {
+          throw new Error(`Missing label: ${label}`);
+        }
+        return dv.getFloat32((i * labels.length + j) * 4, true);
+      };
+      return texts.map((_, i) => ({
+        negative: score(i, "negative"),
+        neutral: score(i, "neutral"),
+        positive: score(i, "positive"),
+      }));
     },
   };
 };
@@ -1,47 +1,149 @@
 from common.data import dump_mmap_matrix
+from common.data import join_sorted_ids
 from common.emb_data import load_ann
 from common.emb_data import load_embs
 from common.emb_data import load_ids
+from common.umap_transform import UmapKnnTransformer
 from common.util import assert_exists
+from threadpoolctl import threadpool_limits
 import joblib
+import multiprocessing as mp
+import numba
 import numpy as np
 import os
 import umap
 
-DATASET = "toppost"
+DATASET = os.getenv("UMAP_DATASET", "toppost")
 MIN_DIST = 0.25
-N_NEIGHBORS = 300
+N_NEIGHBORS = int(os.getenv("UMAP_N_NEIGHBORS", "300"))
+# If nonzero, fit on a sample of this many rows stratified by ID (i.e. time), then transform every other row in batches across a process pool. Otherwise, fit on every row, using the ANN index's neighbor graph. Fitting on everything is infeasible for the post and comment datasets.
+FIT_SAMPLE = int(os.getenv("UMAP_FIT_SAMPLE", "0"))
+TRANSFORM_BATCH = int(os.getenv("UMAP_TRANSFORM_BATCH", "65536"))
+TRANSFORM_WORKERS = int(os.getenv("UMAP_TRANSFORM_WORKERS", str(mp.cpu_count())))
+# How many training rows to keep for the lightweight transformer (see common.umap_transform).
+KNN_REFERENCE = int(os.getenv("UMAP_KNN_REFERENCE", "200000"))
 
 out_name_pfx = f"umap-{DATASET}"
 
+
+def stratified_sample(ids: np.ndarray, count: int, rng: np.random.Generator):
+    # Split the rows, ordered by ID, into `count` equal strata and pick one random row from each, so that the sample covers every period evenly.
+    order = np.argsort(ids, kind="stable")
+    bounds = np.linspace(0, ids.shape[0], count + 1).astype(np.int64)
+    picks = bounds[:-1] + (rng.random(count) * np.diff(bounds)).astype(np.int64)
+    return np.sort(order[picks])
+
+
+_threadpool_limiter = None
+
+
+def init_transform_worker():
+    global _threadpool_limiter
+    # Otherwise, each worker's numba and BLAS use every core, oversubscribing the CPU by a factor of TRANSFORM_WORKERS.
+    threads = max(1, mp.cpu_count() // TRANSFORM_WORKERS)
+    numba.set_num_threads(threads)
+    _threadpool_limiter = threadpool_limits(threads)
+
+
+def transform_rows(rows: np.ndarray):
+    # Runs in a forked worker, so `mapper` and `mat_emb` are inherited instead of pickled.
+    return rows, mapper.transform(np.asarray(mat_emb[rows]))
+
+
+def dump_knn_transformer(
+    embs: np.ndarray, coords: np.ndarray, rng: np.random.Generator
+):
+    rows = np.sort(
+        rng.choice(embs.shape[0], min(embs.shape[0], KNN_REFERENCE), replace=False)
+    )
+    UmapKnnTransformer(
+        embs=np.asarray(embs[rows], dtype=np.float32),
+        coords=coords[rows].astype(np.float32),
+    ).dump(DATASET)
+
+
+rng = np.random.default_rng()
 mat_id_orig, mat_emb = load_embs(DATASET)
 
-ann = load_ann(DATASET)
-# Copied from umap nearest_neighbors() function implementation.
-knn_indices, knn_dists = assert_exists(ann.neighbor_graph)
-ann_ids = load_ids(f"ann-{DATASET}")
-mat_emb = mat_emb[np.isin(mat_id_orig, ann_ids)]
-
-print("Training on", mat_emb.shape)
-mapper = umap.UMAP(
-    precomputed_knn=(knn_indices, knn_dists, ann),
-    # Do not set a random state, it prevents parallelisation.
-    n_components=2,
-    metric="cosine",
-    n_neighbors=N_NEIGHBORS,
-    min_dist=MIN_DIST,
-    low_memory=os.getenv("UMAP_LOW_MEMORY", "0") == "1",
-    verbose=True,
-)
-mapper.fit(mat_emb)
-# There's no need to run .transform() since the training data is the whole dataset already.
-mat_umap = mapper.embedding_
+if FIT_SAMPLE:
+    mat_id = mat_id_orig
+    fit_rows = stratified_sample(mat_id, min(FIT_SAMPLE, mat_id.shape[0]), rng)
+    # Deduplicate rows to prevent errors in NNDescent. The duplicates are still transformed below.
+    _, uniq = np.unique(mat_emb[fit_rows], axis=0, return_index=True)
+    fit_rows = np.sort(fit_rows[uniq])
+    mat_fit = np.asarray(mat_emb[fit_rows])
+    print("Training on sample", mat_fit.shape, "of", mat_emb.shape)
+    mapper = umap.UMAP(
+        # Do not set a random state, it prevents parallelisation.
+        n_components=2,
+        metric="cosine",
+        n_neighbors=N_NEIGHBORS,
+        min_dist=MIN_DIST,
+        low_memory=os.getenv("UMAP_LOW_MEMORY", "0") == "1",
+        verbose=True,
+    )
+    mapper.fit(mat_fit)
+    assert type(mapper.embedding_) == np.ndarray
+
+    # Write directly to the output file as batches complete, instead of holding every coordinate and batch result in memory.
+    mat_umap = np.memmap(
+        f"/hndr-data/{out_name_pfx}-emb.mat",
+        dtype=np.float32,
+        mode="w+",
+        shape=(mat_emb.shape[0], 2),
+    )
+    mat_umap[fit_rows] = mapper.embedding_
+    rest = np.setdiff1d(np.arange(mat_emb.shape[0]), fit_rows)
+    batches = [
+        rest[start : start + TRANSFORM_BATCH]
+        for start in range(0, rest.shape[0], TRANSFORM_BATCH)
+    ]
+    print("Transforming", rest.shape[0], "rows in", len(batches), "batches")
+    done = 0
+    with mp.get_context("fork").Pool(
+        TRANSFORM_WORKERS, initializer=init_transform_worker
+    ) as pool:
+        for rows, coords in pool.imap_unordered(transform_rows, batches):
+            mat_umap[rows] = coords
+            done += rows.shape[0]
+            print(f"Transformed {done} of {rest.shape[0]} rows")
+    mat_umap.flush()
+    dump_knn_transformer(mat_fit, mapper.embedding_, rng)
+else:
+    ann = load_ann(DATASET)
+    # Copied from umap nearest_neighbors() function implementation.
+    knn_indices, knn_dists = assert_exists(ann.neighbor_graph)
+    ann_ids = load_ids(f"ann-{DATASET}")
+    # The ANN index was built on deduplicated rows in a different order, so select rows in the order of `ann_ids` (which is also how the UMAP output rows are labelled), not the original order.
+    ann_rows, emb_rows = join_sorted_ids(ann_ids, mat_id_orig)
+    assert ann_rows.shape[0] == ann_ids.shape[0]
+    mat_id = ann_ids
+    mat_emb = mat_emb[emb_rows]
+
+    print("Training on", mat_emb.shape)
+    mapper = umap.UMAP(
+        precomputed_knn=(knn_indices, knn_dists, ann),
+        # Do not set a random state, it prevents parallelisation.
+        n_components=2,
+        metric="cosine",
+        n_neighbors=N_NEIGHBORS,
+        min_dist=MIN_DIST,
+        low_memory=os.getenv("UMAP_LOW_MEMORY", "0") == "1",
+        verbose=True,
+    )
+    mapper.fit(mat_emb)
+    # There's no need to run .transform() since the training data is the whole dataset already.
+    mat_umap = mapper.embedding_
+    assert type(mat_umap) == np.ndarray
+    assert mat_umap.shape == (mat_emb.shape[0], 2)
+    dump_mmap_matrix(f"{out_name_pfx}-emb", mat_umap)
+    dump_knn_transformer(mat_emb, mat_umap, rng)
+
+# The rows of the output are labelled by these IDs.
+with open(f"/hndr-data/{out_name_pfx}-ids.mat", "wb") as f:
+    f.write(mat_id.astype(np.uint32).tobytes())
 # Save the UMAP model for later use.
 with open(f"/hndr-data/{out_name_pfx}-model.joblib", "wb") as f:
     joblib.dump(mapper, f)
 
-assert type(mat_umap) == np.ndarray
-assert mat_umap.shape == (mat_emb.shape[0], 2)
-dump_mmap_matrix(f"{out_name_pfx}-emb", mat_umap)
-
 print("All done!")